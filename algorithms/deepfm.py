@@ -3,15 +3,24 @@ import torch.nn as nn
 
 """
 Short DeepFM implementation
+
+The logit splits into a movie-only part and a user-only part that are combined cheaply:
+ - the first MLP layer is linear in cat([movie_dense, user_dense]), so it is W_movie @ movie_dense + W_user @ user_dense
+ - the FM interaction sum over all (movie embedding i, user embedding j) pairs is <sum_i movie_i, sum_j user_j>
+ - the additive terms are already separate
+`movie_tower` / `user_tower` compute the two parts and `head` combines them. `cache_movies` + `score_movies`
+keep the movie parts of the whole catalogue so scoring a user against it only runs the user side and the MLP tail.
+`retrieval_embeddings` / `retrieval_queries` expose the FM part as a plain dot product for nearest-neighbour retrieval.
 """
 
 class DeepFM(nn.Module):
     def __init__(self, movie_vector_size: int, user_vector_size: int, num_dense_movie_embeddings: int, num_dense_user_embeddings: int, dense_embedding_size: int, mlp_sizes: list):
         super().__init__()
-        
+
         self.movie_dense_embeddings = nn.Linear(movie_vector_size, dense_embedding_size * num_dense_movie_embeddings + 1)
         self.user_dense_embeddings = nn.Linear(user_vector_size, dense_embedding_size * num_dense_user_embeddings + 1)
         self.dense_embedding_size = dense_embedding_size
+        self.movie_dense_size = dense_embedding_size * num_dense_movie_embeddings
 
         assert mlp_sizes[-1] == 1
         mlp_input_size = (num_dense_movie_embeddings + num_dense_user_embeddings) * dense_embedding_size
@@ -26,20 +35,87 @@ class DeepFM(nn.Module):
 
         self.mlp = nn.Sequential(*mlp_layers)
 
-    def forward(self, movie_vectors, user_vectors):
-        batch_size = movie_vectors.shape[0]
+        # (movie_vectors_fn, num_movies, chunk_size), weights key, (hidden, dense sum, additive) for every movie
+        self._movie_source = None
+        self._movie_cache_key = None
+        self._movie_cache = None
+
+    def movie_tower(self, movie_vectors):
+        """
+        [..., movie_vector_size] -> first MLP layer pre-activation contribution (including its bias), sum of the dense embeddings, additive term
+        """
         movie_dense = self.movie_dense_embeddings(movie_vectors)
+        first_layer = self.mlp[0]
+        hidden = nn.functional.linear(movie_dense[..., :-1], first_layer.weight[:, :self.movie_dense_size], first_layer.bias)
+        dense_sum = movie_dense[..., :-1].unflatten(-1, (-1, self.dense_embedding_size)).sum(dim=-2)
+        return hidden, dense_sum, movie_dense[..., -1]
+
+    def user_tower(self, user_vectors):
         user_dense = self.user_dense_embeddings(user_vectors)
+        first_layer = self.mlp[0]
+        hidden = nn.functional.linear(user_dense[..., :-1], first_layer.weight[:, self.movie_dense_size:])
+        dense_sum = user_dense[..., :-1].unflatten(-1, (-1, self.dense_embedding_size)).sum(dim=-2)
+        return hidden, dense_sum, user_dense[..., -1]
+
+    def head(self, movie_parts, user_parts):
+        """
+        Combine (broadcastable) movie and user tower outputs into logits with the shape of the broadcast batch.
+        """
+        movie_hidden, movie_sum, movie_additive = movie_parts
+        user_hidden, user_sum, user_additive = user_parts
+        mlp_out = self.mlp[1:](movie_hidden + user_hidden).squeeze(-1)
+        fm_interactions = (movie_sum * user_sum).sum(dim=-1)
+        return mlp_out + movie_additive + user_additive + fm_interactions
+
+    def forward(self, movie_vectors, user_vectors):
+        logit = self.head(self.movie_tower(movie_vectors), self.user_tower(user_vectors))
+        return logit.unsqueeze(-1)
+
+    def retrieval_embeddings(self, movie_vectors):
+        """
+        Dot-product retrieval embedding for movies. <retrieval embedding, retrieval query> is the FM part of the logit
+        (interactions + movie additive term), so ranking by it only leaves out the MLP term.
+        """
+        _, dense_sum, additive = self.movie_tower(movie_vectors)
+        return torch.cat([dense_sum, additive.unsqueeze(-1)], dim=-1)
 
-        # calculate factorization machine hidden states
-        fm_additive = movie_dense[..., -1] + user_dense[..., -1]
-        movie_dense_split = movie_dense[..., :-1].view(batch_size, -1, self.dense_embedding_size)
-        user_dense_split = user_dense[..., :-1].view(batch_size, -1, self.dense_embedding_size)
-        fm_interactions = torch.einsum('bik,bjk->bij', movie_dense_split, user_dense_split).view(batch_size, -1)
+    def retrieval_queries(self, user_vectors):
+        _, dense_sum, _ = self.user_tower(user_vectors)
+        return torch.cat([dense_sum, torch.ones_like(dense_sum[..., :1])], dim=-1)
 
-        all_dense = torch.cat([movie_dense[..., :-1], user_dense[..., :-1]], dim=-1)
+    def _movie_weights_key(self):
+        # in-place optimizer steps and load_state_dict bump a parameter's version; replacing it changes its storage
+        params = [*self.movie_dense_embeddings.parameters(), *self.mlp[0].parameters()]
+        return tuple((p.data_ptr(), p._version) for p in params)
 
-        logit = self.mlp(all_dense) + fm_additive.unsqueeze(-1) + fm_interactions.sum(dim=-1, keepdim=True)
+    @torch.no_grad()
+    def cache_movies(self, movie_vectors_fn, num_movies: int, chunk_size: int = 65536):
+        """
+        Precompute the movie tower for movie indices 0..num_movies-1. `movie_vectors_fn(indices)` returns their
+        movie vectors (e.g. `MovieMetadataTable.lookup`). The cache is rebuilt by `score_movies` when the weights change.
+        """
+        self._movie_source = (movie_vectors_fn, num_movies, chunk_size)
+        parts = [
+            self.movie_tower(movie_vectors_fn(torch.arange(start, min(start + chunk_size, num_movies))).float())
+            for start in range(0, num_movies, chunk_size)
+        ]
+        self._movie_cache = tuple(torch.cat(part) for part in zip(*parts))
+        self._movie_cache_key = self._movie_weights_key()
 
-        return logit
+    @torch.no_grad()
+    def score_movies(self, user_vectors, movie_indices=None):
+        """
+        Score cached movies for a batch of users.
 
+        :param user_vectors: [num_users, user_vector_size]
+        :param movie_indices: None for the whole catalogue, [num_movies] for the same movies for every user, or [num_users, num_movies]
+        :returns: [num_users, num_movies] logits
+        """
+        assert self._movie_source is not None, "call cache_movies first"
+        if self._movie_cache_key != self._movie_weights_key():
+            self.cache_movies(*self._movie_source)
+        movie_parts = self._movie_cache
+        if movie_indices is not None:
+            movie_parts = tuple(part[movie_indices] for part in movie_parts)
+        user_hidden, user_sum, user_additive = self.user_tower(user_vectors)
+        return self.head(movie_parts, (user_hidden.unsqueeze(-2), user_sum.unsqueeze(-2), user_additive.unsqueeze(-1)))
@@ -1,53 +1,417 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
 import torch
-from torch.distributions import MultivariateNormal
 
 """
 LinCB is an interesting potential algorithm.
 It requires finding a matrix inverse for an NxN matrix, though, where N is the number of features.
 If our embedding matrices are too large, we will need to reduce their dimensionality.
 Fortunately, it seems like the text embedding vectors have 384 dimensions, which isn't too large.
+
+Update methods (with b = rows in the update batch, d = vector dims):
+ - "inverse": recompute the inverse from scratch, O(d^3) per update
+ - "sherman_morrison": b rank-1 updates of the inverse, O(b d^2)
+ - "woodbury": one rank-b update of the inverse, O(b d^2) but as a few matmuls instead of a Python loop.
+   The policy is updated with the same identity, solving only the b x b inner system (Cholesky + triangular solves)
+   instead of multiplying with the whole inverse.
+ - "cholesky": keep the Cholesky factor of lambda_matrix instead of an inverse, with rank-k up/downdates
+   (`cholesky_update`, O(k d^2)), and get the policy with triangular solves. Each row of a batch is one
+   vectorized rank-1 step, so for batches of more than `max_update_rows` rows recomputing the factor
+   (LAPACK potrf, ~d^3 / 3) is cheaper and is used instead.
+Both batched methods refactor lambda_matrix every `refactor_every` rows (and whenever an update is not positive
+definite) to stop floating point drift; the policy is then solved from the new Cholesky factor.
+`downdate` removes observations again (e.g. for a sliding window) with the same methods.
+
+Exploration uses a square root F of the covariance lambda_matrix^-1 that is factorized once per update
+(not once per call): Thompson sampling draws any number of policies with one matmul, and UCB widths are |F^T x|.
+
+LinCBBank keeps one LinCB per user (or cluster) as stacked tensors, so many users are updated and scored in a few batched ops.
 """
 
+UPDATE_METHODS = ("inverse", "sherman_morrison", "woodbury", "cholesky")
+
+def cholesky_update(cholesky, context, sign):
+    """
+    Lower Cholesky factor of cholesky @ cholesky.T + sign * context.T @ context, for sign = +1 (update) or -1 (downdate).
+    Returns None if the result is not positive definite.
+
+    Every row z is one rank-1 step of Gill, Golub, Murray & Saunders' method C on the L D L^T form. The step's
+    recurrences are prefix sums, so it runs as a triangular solve and a few d x d elementwise ops rather than a
+    loop over columns: with L p = z,
+        1 / a_j = sign + sum_{i<j} p_i^2 / d_i,   d'_j = d_j + a_j p_j^2,   beta_j = a_j p_j / d'_j
+        L'_rj = L_rj + beta_j (z_r - sum_{i<=j} L_ri p_i)   for r > j
+    """
+    diag = cholesky.diagonal()
+    unit = cholesky / diag
+    d = diag * diag
+    work = torch.empty_like(unit)
+    for z in context:
+        p = torch.linalg.solve_triangular(unit, z.unsqueeze(-1), upper=False, unitriangular=True).squeeze(-1)
+        ratio = p * p / d
+        a = 1 / (sign + torch.cumsum(ratio, 0) - ratio)
+        new_d = d + a * p * p
+        if not (torch.isfinite(new_d).all() and (new_d > 0).all()):
+            return None
+        torch.mul(unit, p, out=work)
+        torch.cumsum(work, dim=1, out=work)
+        torch.sub(z.unsqueeze(-1), work, out=work)
+        unit.add_(work.mul_(p * a / new_d).tril_(-1))
+        d = new_d
+    return unit.mul_(d.sqrt())
+
 # potential evaluation method: regression error
 class LinCB:
-    def __init__(self, vector_dims: int, use_sherman_morrison_inverse = False):
+    def __init__(self, vector_dims: int, use_sherman_morrison_inverse = False, update_method: str = None, refactor_every: int = 1024, max_update_rows: int = None):
         self.vector_dims = vector_dims
+        self.update_method = update_method or ("sherman_morrison" if use_sherman_morrison_inverse else "inverse")
+        assert self.update_method in UPDATE_METHODS, f"update_method must be one of {UPDATE_METHODS}"
         self.lambda_matrix = torch.eye(vector_dims)
-        self.lambda_matrix_inv = torch.eye(vector_dims)
+        # the cholesky method keeps lambda_cholesky (lower triangular) and leaves lambda_matrix_inv as None
+        self.lambda_matrix_inv = torch.eye(vector_dims) if self.update_method != "cholesky" else None
+        self.lambda_cholesky = torch.eye(vector_dims) if self.update_method == "cholesky" else None
+        self.refactor_every = refactor_every
+        # cholesky method: larger batches refactor instead of up/downdating row by row (the crossover grows with d)
+        self.max_update_rows = max_update_rows if max_update_rows is not None else max(1, vector_dims // 256)
+        self.rows_since_refactor = 0
+        # square root of the posterior covariance for Thompson sampling / UCB, recomputed lazily after each update
+        self._exploration_factor = None
         # cumulative sum of phi_i * r_i for i = 1 ... t - 1
         self.phir_sum = torch.zeros(vector_dims)
-        self.use_sherman_morrison_inverse = use_sherman_morrison_inverse
         self.policy = torch.zeros(vector_dims) # placeholder. Requires at least one example to calibrate.
 
     def update(self, context, reward):
         """
-        Context shape must be [batch, vector dims].
+        Context shape must be [batch, vector dims], reward shape [batch].
         We can update with a whole batch at a time if we want.
         """
+        self._update(context, reward, 1.0)
+
+    def downdate(self, context, reward):
+        """
+        Remove observations that were previously passed to `update`.
+        """
+        self._update(context, reward, -1.0)
+
+    def _update(self, context, reward, sign):
+        reward = torch.as_tensor(reward, dtype=context.dtype).reshape(-1)
         # [vector_dims, batch] @ [batch, vector_dims] => [vector_dims, vector_dims], which is the correct shape.
         # Reasoning is that context is a set of *row* vectors, and to compute the outer product for several column vectors
         outer_product = context.T @ context
-        self.lambda_matrix += outer_product
-        self.phir_sum += reward * context
-        # We can theoretically make this inverse calculation faster by using the Sherman-Morrison formula.
-        if self.use_sherman_morrison_inverse:
-            # Update the matrix one-by-one
-            for i in range(len(context)):
-                u = context[i].unsqueeze(1)
-                self.lambda_matrix_inv -= (self.lambda_matrix_inv @ (u @ u.T) @ self.lambda_matrix_inv) / (1 + u.T @ self.lambda_matrix_inv @ u)
-        else:
+        self.lambda_matrix += sign * outer_product
+        # [batch] @ [batch, vector_dims] => [vector_dims]
+        self.phir_sum += sign * (reward @ context)
+        self.rows_since_refactor += len(context)
+        self._exploration_factor = None
+
+        if self.update_method == "inverse":
             self.lambda_matrix_inv = torch.inverse(self.lambda_matrix)
-        # Ensure symmetry (because of floating point errors)
-        self.lambda_matrix_inv = (self.lambda_matrix_inv + self.lambda_matrix_inv.T) / 2
-        # make sure!!!! that it is symmetric
-        self.policy = self.lambda_matrix_inv @ self.phir_sum
+        elif self.update_method == "sherman_morrison":
+            # Update the matrix one-by-one: (A + s u u^T)^-1 = A^-1 - s (A^-1 u)(A^-1 u)^T / (1 + s u^T A^-1 u)
+            for u in context:
+                v = self.lambda_matrix_inv @ u
+                self.lambda_matrix_inv -= sign * torch.outer(v, v) / (1 + sign * (u @ v))
+        elif self.update_method == "woodbury":
+            if self.rows_since_refactor >= self.refactor_every or not self._woodbury_update(context, reward, sign):
+                self._refactor()
+        else:
+            cholesky = None
+            if self.rows_since_refactor < self.refactor_every and len(context) <= self.max_update_rows:
+                cholesky = cholesky_update(self.lambda_cholesky, context, sign)
+            if cholesky is None:
+                self._refactor()
+            else:
+                self.lambda_cholesky = cholesky
+                self.policy = torch.cholesky_solve(self.phir_sum.unsqueeze(-1), cholesky).squeeze(-1)
+
+        if self.lambda_matrix_inv is not None:
+            # Ensure symmetry (because of floating point errors)
+            self.lambda_matrix_inv = (self.lambda_matrix_inv + self.lambda_matrix_inv.T) / 2
+            # make sure!!!! that it is symmetric
+            if self.update_method in ("inverse", "sherman_morrison"):
+                self.policy = self.lambda_matrix_inv @ self.phir_sum
+
+    def _woodbury_update(self, context, reward, sign):
+        """
+        (A + s X^T X)^-1 = A^-1 - s V (I + s X V)^-1 V^T with V = A^-1 X^T, for s = +1 (update) or -1 (downdate).
+        The policy follows from the same identity: with y = A^-1 (b + s X^T r) = policy + s V r,
+        the new policy is y - s V (I + s X V)^-1 X y, which only solves the b x b inner system.
+        Returns False if the inner matrix is not positive definite (e.g. a downdate of rows that were never added).
+        """
+        v = self.lambda_matrix_inv @ context.T
+        inner = torch.eye(len(context), dtype=context.dtype) + sign * (context @ v)
+        inner_cholesky, info = torch.linalg.cholesky_ex(inner)
+        if info != 0:
+            return False
+        self.lambda_matrix_inv -= sign * (v @ torch.cholesky_solve(v.T, inner_cholesky))
+        y = self.policy + sign * (v @ reward)
+        self.policy = y - sign * (v @ torch.cholesky_solve((context @ y).unsqueeze(-1), inner_cholesky)).squeeze(-1)
+        return True
 
-    def __call__(self, context, use_thompson_sampling=False):
+    def _refactor(self):
+        """
+        Factorize lambda_matrix from scratch and solve the policy from the factor with triangular solves.
+        """
+        cholesky = torch.linalg.cholesky(self.lambda_matrix)
+        if self.update_method == "cholesky":
+            self.lambda_cholesky = cholesky
+        else:
+            self.lambda_matrix_inv = torch.cholesky_inverse(cholesky)
+        self.policy = torch.cholesky_solve(self.phir_sum.unsqueeze(-1), cholesky).squeeze(-1)
+        self.rows_since_refactor = 0
+
+    def exploration_factor(self):
+        """
+        F with F @ F.T = lambda_matrix^-1, the posterior covariance of the policy.
+        Computed on first use after an update and cached until the next one.
+        """
+        if self._exploration_factor is None:
+            factor, info = None, 1
+            if self.lambda_matrix_inv is not None:
+                factor, info = torch.linalg.cholesky_ex(self.lambda_matrix_inv)
+            if info != 0:
+                # (L L^T)^-1 = L^-T L^-1, so L^-T is a factor; also the fallback if drift made the inverse indefinite
+                cholesky = self.lambda_cholesky if self.lambda_cholesky is not None else torch.linalg.cholesky(self.lambda_matrix)
+                factor = torch.linalg.solve_triangular(cholesky, torch.eye(self.vector_dims), upper=False).T
+            self._exploration_factor = factor
+        return self._exploration_factor
+
+    def sample_policies(self, num_samples: int):
+        """
+        [num_samples, vector_dims] Thompson samples policy + F z, z ~ N(0, I), drawn with one matmul.
+        """
+        z = torch.randn(num_samples, self.vector_dims)
+        return self.policy + z @ self.exploration_factor().T
+
+    def ucb(self, context, alpha: float = 1.0):
+        """
+        Upper confidence bound scores context @ policy + alpha * sqrt(x^T lambda_matrix^-1 x) for every row x of context.
+        The quadratic forms for the whole batch are one matmul: x^T F F^T x = |F^T x|^2.
+        """
+        widths = (context @ self.exploration_factor()).square().sum(dim=-1).sqrt()
+        return context @ self.policy + alpha * widths
+
+    def __call__(self, context, use_thompson_sampling=False, num_samples=None):
+        """
+        Scores [batch] for context [batch, vector_dims]. With Thompson sampling and `num_samples` set,
+        scores [num_samples, batch], one row per posterior sample.
+        """
         if not use_thompson_sampling:
             # [batch, vector_dims] @ [vector_dims] => [batch]
             return context @ self.policy
-        
-        distrib = MultivariateNormal(loc=self.policy, covariance_matrix=self.lambda_matrix_inv)
-        policy_with_exploration = distrib.rsample()
-        
-        return context @ policy_with_exploration
+
+        # [batch, vector_dims] @ [vector_dims, num_samples] => [batch, num_samples]
+        scores = (context @ self.sample_policies(num_samples or 1).T).T
+        return scores if num_samples is not None else scores[0]
+
+# per-key (user or cluster) LinCB statistics stacked into batched tensors.
+# a pool of `max_resident` slots holds the lambda matrices of recently active keys in RAM; the least recently used
+# keys are paged out to one .npy file each ([lambda_matrix; phir_sum; policy], (d + 2) x d) and read back when they
+# become active again. Greedy scoring of paged-out keys only reads their policy row.
+class LinCBBank:
+    def __init__(self, vector_dims: int, max_resident: int = 128, spill_dir: str = None):
+        """
+        :params:
+         - `max_resident`: keys kept in RAM (memory: max_resident * (vector_dims + 2) * vector_dims * 4 bytes,
+           e.g. 330 MB for 128 keys at 800 dims)
+         - `spill_dir`: where paged-out keys are written. Defaults to a temporary directory.
+        """
+        self.vector_dims = vector_dims
+        self.max_resident = max_resident
+        # a spill directory the bank created itself is deleted with the bank; a caller's is left alone
+        self.owns_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir if spill_dir is not None else tempfile.mkdtemp(prefix="lincb_bank_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self.lambda_matrices = torch.eye(vector_dims).repeat(max_resident, 1, 1)
+        self.phir_sums = torch.zeros(max_resident, vector_dims)
+        self.policies = torch.zeros(max_resident, vector_dims)
+
+        self.keys = []
+        self.key_to_id = {}
+        # resident key id -> slot, least recently used first
+        self.resident = OrderedDict()
+        self.free_slots = list(range(max_resident - 1, -1, -1))
+        # resident keys that changed since they were last written to disk
+        self.dirty = set()
+        # key id -> the .npy file holding its latest paged-out copy, if any
+        self.files = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        """
+        Delete the temporary spill directory, if the bank created one. Save the bank first to keep it.
+        """
+        if self.owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.owns_spill_dir = False
+
+    def __del__(self):
+        # the constructor may have failed before the attribute was set
+        if getattr(self, "owns_spill_dir", False):
+            self.close()
+
+    def ids(self, keys, create: bool = True):
+        """
+        Map keys to ids, registering keys seen for the first time. With `create=False`, unknown keys map to -1.
+        """
+        ids = []
+        for key in keys:
+            key_id = self.key_to_id.get(key)
+            if key_id is None:
+                if not create:
+                    ids.append(-1)
+                    continue
+                key_id = len(self.keys)
+                self.keys.append(key)
+                self.key_to_id[key] = key_id
+            ids.append(key_id)
+        return torch.tensor(ids, dtype=torch.long)
+
+    def update(self, keys, context, reward):
+        """
+        Batched update for many keys at once: row i of context [batch, vector_dims] with reward[i] goes to keys[i].
+        """
+        ids = self.ids(keys)
+        reward = torch.as_tensor(reward, dtype=context.dtype).reshape(-1)
+        unique_ids, inverse = torch.unique(ids, return_inverse=True)
+        # a batch can touch more keys than fit in RAM; update them max_resident keys at a time
+        for start in range(0, len(unique_ids), self.max_resident):
+            rows = (inverse >= start) & (inverse < start + self.max_resident)
+            self._update_group(unique_ids[start:start + self.max_resident], inverse[rows] - start, context[rows], reward[rows])
+
+    def _update_group(self, unique_ids, group, context, reward):
+        slots = self._make_resident(unique_ids.tolist())
+        # pad every key's rows into [num_keys, max rows, vector_dims] so all the X^T X are one bmm
+        order = torch.argsort(group, stable=True)
+        group, context, reward = group[order], context[order], reward[order]
+        counts = torch.bincount(group, minlength=len(unique_ids))
+        position = torch.arange(len(group)) - (torch.cumsum(counts, 0) - counts)[group]
+        padded = torch.zeros(len(unique_ids), int(counts.max()), self.vector_dims, dtype=context.dtype)
+        padded[group, position] = context
+
+        self.lambda_matrices.index_add_(0, slots, padded.transpose(1, 2) @ padded)
+        self.phir_sums.index_add_(0, slots[group], reward.unsqueeze(-1) * context)
+        cholesky = torch.linalg.cholesky(self.lambda_matrices[slots])
+        self.policies[slots] = torch.cholesky_solve(self.phir_sums[slots].unsqueeze(-1), cholesky).squeeze(-1)
+        self.dirty.update(unique_ids.tolist())
+
+    def get_policies(self, keys):
+        """
+        [batch, vector_dims] policies. Paged-out keys are not paged in; unknown keys get the prior policy (zeros).
+        """
+        ids = self.ids(keys, create=False)
+        policies = torch.zeros(len(ids), self.vector_dims)
+        for i, key_id in enumerate(ids.tolist()):
+            slot = self.resident.get(key_id)
+            if slot is not None:
+                policies[i] = self.policies[slot]
+            elif key_id in self.files:
+                policies[i] = torch.from_numpy(np.array(np.load(self.files[key_id], mmap_mode="r")[self.vector_dims + 1]))
+        return policies
+
+    def sample_policies(self, keys):
+        """
+        [batch, vector_dims] Thompson samples, one per key. Known keys are paged in; unknown keys sample from the prior N(0, I).
+        """
+        ids = self.ids(keys, create=False)
+        samples = torch.randn(len(ids), self.vector_dims)
+        known = torch.nonzero(ids >= 0).squeeze(-1)
+        unique_ids, inverse = torch.unique(ids[known], return_inverse=True)
+        for start in range(0, len(unique_ids), self.max_resident):
+            rows = (inverse >= start) & (inverse < start + self.max_resident)
+            slots = self._make_resident(unique_ids[start:start + self.max_resident].tolist())[inverse[rows] - start]
+            # policy + L^-T z has covariance (L L^T)^-1
+            cholesky = torch.linalg.cholesky(self.lambda_matrices[slots])
+            z = samples[known[rows]].unsqueeze(-1)
+            noise = torch.linalg.solve_triangular(cholesky.transpose(1, 2), z, upper=True).squeeze(-1)
+            samples[known[rows]] = self.policies[slots] + noise
+        return samples
+
+    def __call__(self, keys, context, use_thompson_sampling=False):
+        """
+        Score candidate sets for a batch of keys: context is [batch, candidates, vector_dims] (one set per key)
+        or [candidates, vector_dims] (shared). Returns [batch, candidates].
+        """
+        policies = self.sample_policies(keys) if use_thompson_sampling else self.get_policies(keys)
+        if context.dim() == 2:
+            return policies @ context.T
+        return torch.bmm(context, policies.unsqueeze(-1)).squeeze(-1)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for key_id in range(len(self.keys)):
+            key_file = os.path.join(path, f"{key_id:08d}.npy")
+            if key_id in self.resident:
+                self._write(key_id, key_file)
+            elif key_id in self.files and os.path.abspath(self.files[key_id]) != os.path.abspath(key_file):
+                shutil.copyfile(self.files[key_id], key_file)
+        with open(os.path.join(path, "keys.json"), "w") as f:
+            json.dump(self.keys, f)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump({"vector_dims": self.vector_dims, "num_keys": len(self.keys)}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str, max_resident: int = 128, spill_dir: str = None):
+        """
+        Open a bank written by `save`. Keys are paged in on demand, and the saved files are never modified.
+        """
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        bank = cls(manifest["vector_dims"], max_resident, spill_dir)
+        with open(os.path.join(path, "keys.json"), "r") as f:
+            bank.keys = json.load(f)
+        bank.key_to_id = {key: i for i, key in enumerate(bank.keys)}
+        for key_id in range(len(bank.keys)):
+            key_file = os.path.join(path, f"{key_id:08d}.npy")
+            if os.path.exists(key_file):
+                bank.files[key_id] = key_file
+        return bank
+
+    def _write(self, key_id, key_file):
+        slot = self.resident[key_id]
+        stats = torch.cat([self.lambda_matrices[slot], self.phir_sums[slot].unsqueeze(0), self.policies[slot].unsqueeze(0)])
+        np.save(key_file, stats.numpy())
+
+    def _make_resident(self, ids):
+        """
+        Page in the keys in `ids` (at most max_resident of them) and return their slots.
+        """
+        slots = []
+        for key_id in ids:
+            slot = self.resident.get(key_id)
+            if slot is None:
+                slot = self._free_slot(keep=set(ids))
+                if key_id in self.files:
+                    stats = torch.from_numpy(np.array(np.load(self.files[key_id], mmap_mode="r")))
+                    self.lambda_matrices[slot] = stats[:self.vector_dims]
+                    self.phir_sums[slot] = stats[self.vector_dims]
+                    self.policies[slot] = stats[self.vector_dims + 1]
+                else:
+                    self.lambda_matrices[slot] = torch.eye(self.vector_dims)
+                    self.phir_sums[slot] = 0
+                    self.policies[slot] = 0
+                self.resident[key_id] = slot
+            self.resident.move_to_end(key_id)
+            slots.append(slot)
+        return torch.tensor(slots, dtype=torch.long)
+
+    def _free_slot(self, keep):
+        if self.free_slots:
+            return self.free_slots.pop()
+        for key_id in self.resident:
+            if key_id in keep:
+                continue
+            if key_id in self.dirty or key_id not in self.files:
+                key_file = os.path.join(self.spill_dir, f"{key_id:08d}.npy")
+                self._write(key_id, key_file)
+                self.files[key_id] = key_file
+                self.dirty.discard(key_id)
+            return self.resident.pop(key_id)
+        raise RuntimeError("more keys requested at once than max_resident")
@@ -93,6 +93,60 @@ def create_hl_gaussian_target(rewards: torch.Tensor, v_min: float, v_max: float,
 
     return probs
 
+class HLGaussLoss(torch.nn.Module):
+    """
+    HL-Gauss cross-entropy loss for a value head with `m` logits, with the bin geometry computed once.
+
+    Targets for rewards in `discrete_rewards` (e.g. the 10 Letterboxd rating values) are precomputed into a
+    [len(discrete_rewards), m] table, so a batch's targets are a single row gather. Any other reward goes through
+    the broadcast fallback `targets`, which evaluates one normal CDF per bin boundary ([batch, m + 1]) without
+    repeating the boundaries per row. `forward` fuses the target lookup with a soft-label cross-entropy.
+    """
+    def __init__(self, v_min: float, v_max: float, m: int, hl_gaussian_sigma_over_binsize: float = 0.75, discrete_rewards=None):
+        super().__init__()
+        bin_size = (v_max - v_min) / m
+        self.sigma = hl_gaussian_sigma_over_binsize * bin_size
+        # m + 1 boundaries; bin i covers [boundaries[i], boundaries[i + 1]]
+        self.register_buffer("bin_boundaries", torch.arange(m + 1).float() * bin_size + v_min)
+        self.register_buffer("bin_centers", self.bin_boundaries[:-1] + bin_size / 2)
+        if discrete_rewards is not None:
+            reward_values = torch.as_tensor(discrete_rewards).float().unique()
+            self.register_buffer("reward_values", reward_values)
+            self.register_buffer("target_table", self.targets(reward_values))
+        else:
+            self.reward_values = None
+
+    def targets(self, rewards: torch.Tensor):
+        """
+        [batch] rewards -> [batch, m] target probabilities. Same values as `create_hl_gaussian_target`.
+        """
+        cdf = normal.cdf((self.bin_boundaries - rewards.float().unsqueeze(-1)) / self.sigma)
+        # the first and last bins also take the tails below v_min / above v_max
+        cdf[..., 0] = 0
+        cdf[..., -1] = 1
+        return cdf[..., 1:] - cdf[..., :-1]
+
+    def lookup_targets(self, rewards: torch.Tensor):
+        """
+        Table lookup for discrete rewards, falling back to `targets` if any reward is not in the table.
+        """
+        if self.reward_values is None:
+            return self.targets(rewards)
+        rewards = rewards.float()
+        index = torch.searchsorted(self.reward_values, rewards).clamp(max=len(self.reward_values) - 1)
+        if not torch.equal(self.reward_values[index], rewards):
+            return self.targets(rewards)
+        return self.target_table[index]
+
+    def forward(self, logits: torch.Tensor, rewards: torch.Tensor):
+        return torch.nn.functional.cross_entropy(logits, self.lookup_targets(rewards))
+
+    def predict(self, logits: torch.Tensor):
+        """
+        Expected value of the predicted distribution: [batch, m] logits -> [batch]
+        """
+        return torch.softmax(logits, dim=-1) @ self.bin_centers
+
 if __name__ == '__main__':
     rewards = torch.tensor([1, 2, 3, 4])
     create_hl_gaussian_target(rewards, v_min=0, v_max=10, m=10, hl_gaussian_sigma_over_binsize=0.75)
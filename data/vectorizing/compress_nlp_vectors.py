@@ -1,12 +1,92 @@
+import os
+import sys
+import numpy as np
 import pandas as pd
-import json
 import torch
 
-data = pd.read_csv("nlp_vectors.csv")
-overview_vectors = torch.tensor([json.loads(s) for s in data['overview_vectors']])
-title_vectors = torch.tensor([json.loads(s) for s in data['title_vectors']])
-data = {
-    "overview_vectors": overview_vectors,
-    "title_vectors": title_vectors
-}
-torch.save(data, "nlp_vectors.pt")
+sys.path.append("../../training")
+from quantized_vectors import Int8Vectors, ProductQuantizedVectors, save_quantized_vectors # type: ignore
+
+"""
+Streaming conversion of nlp_vectors.csv.
+
+The CSV is read in chunks and every chunk's vector strings are parsed by a single numpy call into a
+float32 memory-mapped scratch file, so the vectors never exist as Python lists.
+The output depends on the mode (first command-line argument):
+ - float32 (default): nlp_vectors.pt, the same format as before
+ - int8: nlp_vectors_int8/, per-dimension-scaled int8 codes (4x smaller)
+ - pq: nlp_vectors_pq/, product-quantized codes (16x smaller with 96 subspaces)
+"""
+
+COLUMNS = ["overview_vectors", "title_vectors"]
+CHUNK_SIZE = 10000
+PQ_SUBSPACES = 96
+PQ_TRAINING_SAMPLES = 65536
+
+def count_rows(path):
+    newlines = 0
+    last_byte = b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            newlines += block.count(b"\n")
+            last_byte = block[-1:]
+    # minus the header; plus the last line if it has no trailing newline
+    return newlines - 1 + (last_byte != b"\n")
+
+def parse_vectors(strings):
+    # "[0.1, 0.2, ...]" strings -> one comma-separated string -> one C-level parse
+    flat = np.fromstring(",".join(strings.str[1:-1]), sep=",", dtype=np.float32)
+    return flat.reshape(len(strings), -1)
+
+def csv_to_memmaps(csv_path):
+    """
+    Returns column -> float32 memory-mapped [num_rows, dims] array and column -> per-dimension max |x|.
+    """
+    num_rows = count_rows(csv_path)
+    memmaps = {}
+    max_abs = {}
+    row = 0
+    for chunk in pd.read_csv(csv_path, usecols=COLUMNS, chunksize=CHUNK_SIZE):
+        for column in COLUMNS:
+            vectors = parse_vectors(chunk[column])
+            if column not in memmaps:
+                memmaps[column] = np.lib.format.open_memmap(f"nlp_vectors.{column}.f32.npy", mode="w+", dtype=np.float32, shape=(num_rows, vectors.shape[1]))
+                max_abs[column] = np.zeros(vectors.shape[1], dtype=np.float32)
+            memmaps[column][row:row + len(vectors)] = vectors
+            max_abs[column] = np.maximum(max_abs[column], np.abs(vectors).max(axis=0))
+        row += len(chunk)
+    assert row == num_rows, f"parsed {row} rows, expected {num_rows}"
+    return memmaps, max_abs
+
+def encode_in_chunks(encode, vectors, *args):
+    return np.concatenate([encode(vectors[start:start + CHUNK_SIZE], *args) for start in range(0, len(vectors), CHUNK_SIZE)])
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "float32"
+    memmaps, max_abs = csv_to_memmaps("nlp_vectors.csv")
+
+    if mode == "float32":
+        torch.save({column: torch.from_numpy(np.array(memmaps[column])) for column in COLUMNS}, "nlp_vectors.pt")
+    elif mode == "int8":
+        quantized = {}
+        for column in COLUMNS:
+            scale = Int8Vectors.fit_scale(max_abs[column])
+            codes = encode_in_chunks(Int8Vectors.encode, memmaps[column], scale)
+            quantized[column] = Int8Vectors(torch.from_numpy(codes), torch.from_numpy(scale))
+        save_quantized_vectors("nlp_vectors_int8", quantized)
+    elif mode == "pq":
+        quantized = {}
+        rng = np.random.default_rng(0)
+        for column in COLUMNS:
+            sample_rows = np.sort(rng.choice(len(memmaps[column]), min(PQ_TRAINING_SAMPLES, len(memmaps[column])), replace=False))
+            codebooks = ProductQuantizedVectors.fit_codebooks(memmaps[column][sample_rows], PQ_SUBSPACES)
+            codes = encode_in_chunks(ProductQuantizedVectors.encode, memmaps[column], codebooks)
+            quantized[column] = ProductQuantizedVectors(torch.from_numpy(codes), torch.from_numpy(codebooks))
+        save_quantized_vectors("nlp_vectors_pq", quantized)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    for column in COLUMNS:
+        filename = memmaps[column].filename
+        del memmaps[column]
+        os.remove(filename)
@@ -1,88 +1,65 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
-import json
+import os
+import sys
 import torch
 import transformers
 
-@st.cache_data
-def load_data(filepath):
-    data = pd.read_csv(filepath)
-    data.dropna(subset=['year_released'], inplace=True)
-    drop_cols = ['image_url', 'imdb_id', 'imdb_link', 'tmdb_id', 'tmdb_link']
-    data.drop(drop_cols, axis=1, inplace=True)
-    data['year_released'] = data['year_released'].astype('Int16')
-    data['runtime'] = data['runtime'].astype('Int16', errors='ignore')
-    data.set_index('movie_id', inplace=True)
-    return data
+sys.path.append("training")
+from fast_checkpoint import fast_checkpoint_dir, load_fast_checkpoint # type: ignore
+from movie_catalogue import MovieCatalogue, compile_catalogue # type: ignore
+from rating_prompts import RATING_VALUES, RatingPromptCache # type: ignore
+from rating_scorer import RatingScorer # type: ignore
+
+@st.cache_resource()
+def load_catalogue(catalogue_dir, movie_data_file):
+    # built once from the CSV (again when the store format changes); afterwards only the titles, the title search
+    # index and typed numeric columns are loaded, shared by all sessions
+    if os.path.exists(catalogue_dir):
+        try:
+            return MovieCatalogue(catalogue_dir)
+        except ValueError:
+            pass
+    compile_catalogue(movie_data_file, catalogue_dir)
+    return MovieCatalogue(catalogue_dir)
 
 @st.cache_resource()
 def load_model(model_path, tokenizer_name="openai-community/gpt2"):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = torch.load(model_path, map_location=device)
+    # memory-mapped safetensors + local fast tokenizer, written by `python fast_checkpoint.py` in training/
+    if os.path.isdir(fast_checkpoint_dir(model_path)):
+        return load_fast_checkpoint(fast_checkpoint_dir(model_path), device)
+    model = torch.load(model_path, map_location=device, weights_only=False).to(device)
+    # the pickled module may have been saved in training mode (dropout on)
+    model.eval()
     tokenizer = transformers.GPT2Tokenizer.from_pretrained(tokenizer_name)
-    if device.type == "cuda":
-        model = model.to("cuda")
     return model, tokenizer
 
-movie_data = load_data('data/movie_data.csv')
+movie_catalogue = load_catalogue('data/catalogue', 'data/movie_data.csv')
 gpt2, gpt2_tokenizer = load_model("training/gpt-2-letterboxd-tune-000.pt")
-nan2list = lambda x: x if type(x) is str else '[]'
+# most voted matches shown in the sidebar
+SEARCH_LIMIT = 100
 
-def format_movie_data_v2(movie_data): # , user_rating, user_review):
-    release_yr = movie_data.get("year_released", None)
-    title_fmt = movie_data.get("movie_title", "N/A") + (f" ({release_yr})" if release_yr else "")
-    genre_fmt = ' and '.join([x.lower() for x in json.loads(nan2list(movie_data.get('genres', "[]")))])
-    runtime = movie_data.get('runtime', None)
-    if runtime is not None and not np.isnan(runtime):
-        hours = int(runtime // 60)
-        minutes = int(runtime % 60)
-        runtime_fmt = f"{hours}h {minutes}m"
-    else:
-        runtime_fmt = "N/A"
-    
-    avg_rating = movie_data.get('vote_average')
-    votes = movie_data.get('vote_count')
-    if votes is not None and not np.isnan(votes) and votes > 0:
-        votes = int(votes)
-        avg_rating_fmt = f"{avg_rating:.2f} ({votes} vote(s))"
-    else:
-        avg_rating_fmt = "N/A"
-    
-    production_countries_fmt = ' and '.join(json.loads(nan2list(movie_data.get('production_countries', "[]")))) or 'N/A'
-    languages_fmt = ' and '.join(json.loads(nan2list(movie_data.get('spoken_languages', "[]")))) or 'N/A'
-    overview = movie_data.get("overview", "N/A")
-    
-    return f"""
-Title: {title_fmt}
-Genres: {genre_fmt}
-Runtime: {runtime_fmt}
-Average rating: {avg_rating_fmt}
-Production countries: {production_countries_fmt}
-Languages: {languages_fmt}
-Overview: {overview}
-""".strip()
+@st.cache_resource()
+def load_scorer(max_movies=4096):
+    # formatted, tokenized movie blocks shared by all sessions
+    return RatingScorer(gpt2, RatingPromptCache(gpt2_tokenizer, movie_catalogue.record, max_movies))
+
+scorer = load_scorer()
 
 def process_selected_movies(selected_movie_ids, movie_ratings):
-    string = ""
-    for movie, rating in zip(selected_movie_ids, movie_ratings):
-        mv = movie_data.loc[movie]
-        formatted = format_movie_data_v2(mv)
-        string += f"---\n{formatted}\n---\nRating: {rating} / 10\n"
-        
-    tokenization = gpt2_tokenizer(string, return_tensors='pt', truncation=True).to('cuda')
-    with torch.no_grad():
-        out = gpt2.generate(**tokenization, max_new_tokens=1, do_sample=False, pad_token_id=gpt2_tokenizer.eos_token_id)
-    out = gpt2_tokenizer.decode(out[0])
-    try:
-        pred_rating = int(out.split()[-1])
-        st.write(pred_rating)
-        return pred_rating
-    except:
-        print("parse error")
-        st.write(out)
-        return out
-        
+    # the rated movies, oldest first, are the history; the last selected movie gets the rating slot
+    history_movies, query_movie = selected_movie_ids[:-1], selected_movie_ids[-1]
+    history_ratings = [movie_ratings[movie] for movie in history_movies]
+    # KV cache of this session's rated history, so a submit only prefills the movies added since the last one
+    if 'history_cache' not in st.session_state:
+        st.session_state.history_cache = scorer.history_cache()
+    probs, expected = scorer.predict_cached(st.session_state.history_cache, history_movies, history_ratings, query_movie)
+    title = movie_catalogue.titles[movie_catalogue.rows([query_movie])[0]]
+    st.write(f'Predicted rating for "{title}": {expected:.1f} / 10')
+    st.bar_chart(pd.Series(probs.numpy(), index=RATING_VALUES, name="probability"))
+    return expected
+
 def main():
     st.title("Movie Recommendation System")
     st.session_state.movie_ratings = {}
@@ -95,12 +72,12 @@ def main():
         
         # Filtering movies based on search query
         if search_query:
-            filtered_movies = movie_data[movie_data['movie_title'].str.contains(search_query, case=False, na=False)]
+            filtered_rows = movie_catalogue.search_titles(search_query, limit=SEARCH_LIMIT)
         else:
-            filtered_movies = movie_data.head(0)
+            filtered_rows = []
         
         # Display filtered movies in a selectbox, using movie_id as a reference
-        selected_movie_id_list = st.multiselect("Choose a movie:", filtered_movies['movie_title']  + " - " + filtered_movies.index.map(str))
+        selected_movie_id_list = st.multiselect("Choose a movie:", [f"{movie_catalogue.titles[row]} - {movie_catalogue.movie_ids[row]}" for row in filtered_rows])
         
         # Button to add movie to the selection list
         if st.button("Add Movie"):
@@ -115,18 +92,19 @@ def main():
 def add_movie_to_selection(movie_id_list):
     for movie_id in movie_id_list:
         if 'selected_movies' not in st.session_state:
-            st.session_state.selected_movies = set()
-        st.session_state.selected_movies.add(movie_id)
+            # insertion-ordered, so the prompt history keeps the order movies were added in
+            st.session_state.selected_movies = {}
+        st.session_state.selected_movies[movie_id] = None
     st.rerun()
 
 def display_selected_movies():
     # Display the list of selected movies and allow rating
     if 'selected_movies' in st.session_state and st.session_state.selected_movies:
         selected_movie_ids = list(st.session_state.selected_movies)
-        selected_movies = movie_data.loc[selected_movie_ids]
+        selected_rows = movie_catalogue.rows(selected_movie_ids)
         
-        for movie_id, movie in selected_movies.iterrows():
-            rating = st.number_input(f'Rate "{movie["movie_title"]}":', min_value=1, max_value=10, value=5, key=movie_id)
+        for movie_id, row in zip(selected_movie_ids, selected_rows):
+            rating = st.number_input(f'Rate "{movie_catalogue.titles[row]}":', min_value=1, max_value=10, value=5, key=movie_id)
             st.session_state.movie_ratings[movie_id] = rating
         
         if st.button("Submit Ratings"):
@@ -0,0 +1,49 @@
+import time
+import torch
+
+from bench_movie_lookup import FEATURE_STORE_DIR, NUM_MOVIES, synthetic_table
+from movie_metadata_table import MovieMetadataTable
+from recommender import DEEPFM_CONFIG, USER_VECTOR_SIZE
+
+import sys
+sys.path.append("../algorithms")
+from deepfm import DeepFM # type: ignore
+
+"""
+Benchmark for scoring the whole catalogue for one user with DeepFM.
+
+ - forward: the movie vectors of every movie through the full model (what scoring cost before the cached tower)
+ - cached: `score_movies` against the cached movie tower; only the user side and the MLP tail run per query
+"""
+
+NUM_QUERIES = 20
+
+def ms_per_query(fn):
+    fn()
+    start = time.perf_counter()
+    for _ in range(NUM_QUERIES):
+        fn()
+    return (time.perf_counter() - start) / NUM_QUERIES * 1000
+
+if __name__ == '__main__':
+    if FEATURE_STORE_DIR is not None:
+        table = MovieMetadataTable.from_feature_store(FEATURE_STORE_DIR)
+    else:
+        table = synthetic_table(NUM_MOVIES)
+    num_movies = len(table.movie_ids)
+    deepfm = DeepFM(table.movie_vector_size, USER_VECTOR_SIZE, **DEEPFM_CONFIG).eval()
+    user_vector = torch.randn(1, USER_VECTOR_SIZE)
+    all_movies = torch.arange(num_movies)
+
+    def forward():
+        with torch.no_grad():
+            return deepfm(table.lookup(all_movies).float(), user_vector.expand(num_movies, -1)).squeeze(-1)
+
+    start = time.perf_counter()
+    deepfm.cache_movies(table.lookup, num_movies)
+    cache_ms = (time.perf_counter() - start) * 1000
+
+    max_error = (deepfm.score_movies(user_vector)[0] - forward()).abs().max().item()
+    before = ms_per_query(forward)
+    after = ms_per_query(lambda: deepfm.score_movies(user_vector))
+    print(f"{num_movies:,} movies | cache build {cache_ms:.0f} ms | forward {before:.1f} ms/query | cached {after:.1f} ms/query ({before / after:.1f}x) | max |diff| {max_error:.2e}")
@@ -0,0 +1,45 @@
+import time
+import torch
+import torch.nn.functional as F
+
+from train_mlp import HL_GAUSS_CONFIG, RATING_VALUES
+
+import sys
+sys.path.append("../algorithms")
+from mlp import HLGaussLoss, create_hl_gaussian_target # type: ignore
+
+"""
+Microbenchmark for the HL-Gauss loss (targets + cross-entropy, forward and backward) per batch.
+
+ - before: `create_hl_gaussian_target` followed by a soft-label cross-entropy
+ - broadcast: `HLGaussLoss` without a target table (continuous rewards)
+ - table: `HLGaussLoss` with the precomputed table for the 10 rating values
+"""
+
+BATCH_SIZES = [256, 4096, 65536]
+NUM_STEPS = 200
+
+def ms_per_step(loss_fn, logits, rewards):
+    loss_fn(logits, rewards).backward()
+    start = time.perf_counter()
+    for _ in range(NUM_STEPS):
+        logits.grad = None
+        loss_fn(logits, rewards).backward()
+    return (time.perf_counter() - start) / NUM_STEPS * 1000
+
+if __name__ == '__main__':
+    broadcast = HLGaussLoss(**HL_GAUSS_CONFIG)
+    table = HLGaussLoss(**HL_GAUSS_CONFIG, discrete_rewards=RATING_VALUES)
+    before = lambda logits, rewards: F.cross_entropy(logits, create_hl_gaussian_target(rewards, **HL_GAUSS_CONFIG))
+
+    for batch_size in BATCH_SIZES:
+        rewards = torch.randint(1, 11, (batch_size,))
+        logits = torch.randn(batch_size, HL_GAUSS_CONFIG["m"], requires_grad=True)
+        max_error = (table.lookup_targets(rewards) - create_hl_gaussian_target(rewards, **HL_GAUSS_CONFIG)).abs().max().item()
+        before_ms = ms_per_step(before, logits, rewards)
+        broadcast_ms = ms_per_step(broadcast, logits, rewards)
+        table_ms = ms_per_step(table, logits, rewards)
+        print(
+            f"batch {batch_size:>6}: before {before_ms:7.3f} ms | broadcast {broadcast_ms:7.3f} ms | "
+            f"table {table_ms:7.3f} ms ({before_ms / table_ms:.1f}x) | max target diff {max_error:.1e}"
+        )
@@ -0,0 +1,75 @@
+import time
+import torch
+import pandas as pd
+
+from movie_metadata_table import MovieMetadataTable
+
+"""
+Microbenchmark for MovieMetadataTable batch lookups (rows/sec).
+
+ - before: per-item dict lookup, three separate gathers, torch.cat, and the .float() copy train_loop used to make
+ - after (encode + lookup): vectorized slug -> index encoding of the batch, then one index_select
+ - after (pre-encoded): the index column is encoded once up front, so a batch is only an index_select
+
+Uses a synthetic table with the real catalogue's shapes unless FEATURE_STORE_DIR is set.
+"""
+
+FEATURE_STORE_DIR = None # e.g. "../data/feature_store"
+NUM_MOVIES = 270422
+BATCH_SIZES = [16, 256, 4096]
+NUM_BATCHES = 200
+
+def synthetic_table(num_movies):
+    movie_ids = [f"movie-{i}" for i in range(num_movies)]
+    table = MovieMetadataTable.__new__(MovieMetadataTable)
+    table.movie_metadata = None
+    table.metadata_columns = None
+    table._set_tensors(movie_ids, torch.randn(num_movies, 32 + 384 + 384), {
+        'movie_tensor': [0, 32],
+        'overview_vectors': [32, 416],
+        'title_vectors': [416, 800],
+    })
+    return table
+
+def lookup_before(table, movie_tensor_f64, movie_slugs):
+    # the original MovieMetadataTable.__call__ followed by train_loop's .float()
+    movie_index = [table.movie_id_to_index[movie_id] for movie_id in movie_slugs]
+    return torch.cat([
+        movie_tensor_f64[movie_index],
+        table.overview_vectors[movie_index],
+        table.title_vectors[movie_index],
+    ], dim=-1).float()
+
+def rows_per_second(fn, batches):
+    fn(batches[0])
+    start = time.perf_counter()
+    rows = 0
+    for batch in batches:
+        out = fn(batch)
+        rows += out.shape[0]
+    return rows / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    if FEATURE_STORE_DIR is not None:
+        table = MovieMetadataTable.from_feature_store(FEATURE_STORE_DIR)
+    else:
+        table = synthetic_table(NUM_MOVIES)
+    # the original table stored metadata columns as float64
+    movie_tensor_f64 = table.movie_tensor.double()
+    num_movies = len(table.movie_ids)
+
+    for batch_size in BATCH_SIZES:
+        indices = torch.randint(0, num_movies, (NUM_BATCHES, batch_size))
+        slug_batches = [pd.Series(table.movie_ids).iloc[batch.numpy()] for batch in indices]
+        slug_lists = [list(batch) for batch in slug_batches]
+
+        before = rows_per_second(lambda slugs: lookup_before(table, movie_tensor_f64, slugs), slug_lists)
+        encode_lookup = rows_per_second(lambda slugs: table.lookup(table.encode(slugs)), slug_batches)
+        pre_encoded = rows_per_second(table.lookup, list(indices))
+
+        print(
+            f"batch {batch_size:>5}: "
+            f"before {before:>12,.0f} rows/s | "
+            f"encode+lookup {encode_lookup:>12,.0f} rows/s | "
+            f"pre-encoded {pre_encoded:>12,.0f} rows/s ({pre_encoded / before:.1f}x)"
+        )
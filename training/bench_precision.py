@@ -0,0 +1,72 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from recommender import DEEPFM_CONFIG, USER_VECTOR_SIZE, load_movie_metadata_table, load_ratings, make_optimizers
+from ratings_loader import RatingsBatchLoader
+
+import sys
+sys.path.append("../algorithms")
+from deepfm import DeepFM # type: ignore
+
+"""
+Validation check for reduced-precision training.
+
+Trains DeepFM with the same seed and data order under each (stored feature dtype, compute precision) pair
+and reports the movie feature memory, the time per training step and the held-out MSE.
+"""
+
+CONFIGS = [
+    ("float32", "fp32"),
+    ("bfloat16", "bf16"),
+    ("float16", "bf16"),
+]
+BATCH_SIZE = 1024
+NUM_STEPS = 500
+HELD_OUT_FRACTION = 0.1
+
+def run(movie_metadata_table, train_ratings, held_out_ratings, num_users, precision):
+    torch.manual_seed(0)
+    user_embedding_table = nn.Embedding(num_users, USER_VECTOR_SIZE, sparse=True)
+    deepfm = DeepFM(movie_metadata_table.movie_vector_size, USER_VECTOR_SIZE, **DEEPFM_CONFIG)
+    optims = make_optimizers(deepfm, [user_embedding_table], "sparse_adam")
+    autocast = lambda: torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=precision == "bf16")
+
+    loader = RatingsBatchLoader(train_ratings, movie_metadata_table, batch_size=BATCH_SIZE, drop_last=True, seed=0)
+    num_steps = 0
+    start = time.perf_counter()
+    for step, (user_index, _, movie_vectors, rating) in enumerate(loader):
+        if step == NUM_STEPS:
+            break
+        with autocast():
+            predictions = deepfm(movie_vectors.float(), user_embedding_table(user_index)).squeeze(-1).float()
+            loss = F.mse_loss(predictions, (rating >= 7).float())
+        for optim in optims:
+            optim.zero_grad()
+        loss.backward()
+        for optim in optims:
+            optim.step()
+        num_steps += 1
+    ms_per_step = (time.perf_counter() - start) / num_steps * 1000
+
+    squared_error = 0.0
+    held_out_loader = RatingsBatchLoader(held_out_ratings, movie_metadata_table, batch_size=8192, shuffle=False)
+    with torch.no_grad(), autocast():
+        for user_index, _, movie_vectors, rating in held_out_loader:
+            predictions = deepfm(movie_vectors.float(), user_embedding_table(user_index)).squeeze(-1).float()
+            squared_error += F.mse_loss(predictions, (rating >= 7).float(), reduction="sum").item()
+    return ms_per_step, squared_error / len(held_out_ratings)
+
+if __name__ == '__main__':
+    ratings = load_ratings()
+    held_out = np.random.default_rng(0).random(len(ratings)) < HELD_OUT_FRACTION
+    train_ratings, held_out_ratings = ratings.subset(~held_out), ratings.subset(held_out)
+    base_table = load_movie_metadata_table()
+
+    for dtype, precision in CONFIGS:
+        movie_metadata_table = base_table.to(dtype)
+        feature_mb = movie_metadata_table.movie_matrix.numel() * movie_metadata_table.movie_matrix.element_size() / 2**20
+        ms_per_step, mse = run(movie_metadata_table, train_ratings, held_out_ratings, len(ratings.user_ids), precision)
+        print(f"features {dtype:>8} ({feature_mb:8.1f} MB) | compute {precision} | {ms_per_step:7.2f} ms/step | held-out MSE {mse:.4f}")
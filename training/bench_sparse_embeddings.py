@@ -0,0 +1,68 @@
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sparse_optim import make_sparse_optimizer
+
+import sys
+sys.path.append("../algorithms")
+from deepfm import DeepFM # type: ignore
+
+"""
+Per-step training time of DeepFM + user embedding table at different user counts,
+comparing dense Adam over every parameter against sparse embedding gradients with SparseAdam / row-wise Adagrad.
+Movie vectors are random, so this isolates the optimizer cost.
+"""
+
+NUM_USERS = [10_000, 100_000, 1_000_000]
+MOVIE_VECTOR_SIZE = 800
+USER_VECTOR_SIZE = 64
+BATCH_SIZE = 1024
+NUM_STEPS = 20
+
+def make_step(num_users, sparse_optimizer):
+    user_embedding_table = nn.Embedding(num_users, USER_VECTOR_SIZE, sparse=sparse_optimizer is not None)
+    deepfm = DeepFM(
+        MOVIE_VECTOR_SIZE,
+        USER_VECTOR_SIZE,
+        num_dense_movie_embeddings=8,
+        num_dense_user_embeddings=4,
+        dense_embedding_size=16,
+        mlp_sizes=[16, 16, 1],
+    )
+    if sparse_optimizer is None:
+        optims = [torch.optim.Adam([*deepfm.parameters(), *user_embedding_table.parameters()], lr=0.001)]
+    else:
+        optims = [
+            torch.optim.Adam(deepfm.parameters(), lr=0.001),
+            make_sparse_optimizer(sparse_optimizer, user_embedding_table.parameters(), lr=0.001),
+        ]
+
+    def step():
+        user_index = torch.randint(0, num_users, (BATCH_SIZE,))
+        movie_vectors = torch.randn(BATCH_SIZE, MOVIE_VECTOR_SIZE)
+        rewards = torch.randint(0, 2, (BATCH_SIZE,)).float()
+        predictions = deepfm(movie_vectors, user_embedding_table(user_index)).squeeze(-1)
+        loss = F.mse_loss(predictions, rewards)
+        for optim in optims:
+            optim.zero_grad()
+        loss.backward()
+        for optim in optims:
+            optim.step()
+
+    return step
+
+if __name__ == '__main__':
+    for num_users in NUM_USERS:
+        results = []
+        for sparse_optimizer in [None, "sparse_adam", "rowwise_adagrad"]:
+            step = make_step(num_users, sparse_optimizer)
+            # warmup also allocates the optimizer state
+            step()
+            start = time.perf_counter()
+            for _ in range(NUM_STEPS):
+                step()
+            ms_per_step = (time.perf_counter() - start) / NUM_STEPS * 1000
+            results.append(f"{sparse_optimizer or 'dense_adam'} {ms_per_step:8.2f} ms/step")
+        print(f"{num_users:>9,} users: " + " | ".join(results))
@@ -0,0 +1,169 @@
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+
+from recommender import (
+    DEEPFM_CONFIG,
+    USER_VECTOR_SIZE,
+    load_movie_metadata_table,
+    load_ratings,
+    make_optimizers,
+    save_checkpoint,
+)
+from movie_metadata_table import MovieMetadataTable
+from ratings_loader import RatingsBatchLoader
+
+import sys
+sys.path.append("../algorithms")
+from deepfm import DeepFM # type: ignore
+
+"""
+Data-parallel CPU training for DeepFM with torch.distributed (gloo).
+
+ - Ratings are sharded by user (user_index % world_size == rank). Every user's embedding row lives
+   on exactly one worker, so user embeddings never need to be synchronized; each worker only allocates
+   the rows for its own users.
+ - Movie features are shared rather than copied: with a feature store every worker memory-maps the same files
+   (one copy in the page cache); otherwise the parent builds the table once and moves it to shared memory.
+ - Dense DeepFM gradients are all-reduced by DistributedDataParallel.
+
+Usage (from the training directory): `python distributed_train.py` trains with one worker per core,
+`python distributed_train.py scaling` prints a samples/sec report at 1/2/4/8 workers.
+"""
+
+def train_worker(
+    rank,
+    world_size,
+    movie_table_source,
+    train_user_ids,
+    train_movie_ids,
+    batch_size,
+    epochs,
+    max_steps,
+    sparse_optimizer,
+    checkpoint_path,
+    results,
+):
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # split the cores between the workers instead of letting every worker's intra-op pool use all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    # every worker constructs identical initial DeepFM weights
+    torch.manual_seed(0)
+
+    if type(movie_table_source) == str:
+        movie_metadata_table = MovieMetadataTable.from_feature_store(movie_table_source)
+    else:
+        movie_metadata_table = movie_table_source
+
+    ratings = load_ratings(train_user_ids, train_movie_ids)
+    shard = (ratings.user_index % world_size) == rank
+    ratings.user_index = ratings.user_index[shard] // world_size
+    ratings.movie_index = ratings.movie_index[shard]
+    ratings.rating = ratings.rating[shard]
+    num_local_users = (len(ratings.user_ids) - rank + world_size - 1) // world_size
+
+    user_embedding_table = nn.Embedding(num_local_users, USER_VECTOR_SIZE, sparse=sparse_optimizer is not None)
+    deepfm = DeepFM(movie_metadata_table.movie_vector_size, USER_VECTOR_SIZE, **DEEPFM_CONFIG)
+    ddp_deepfm = DistributedDataParallel(deepfm)
+    optims = make_optimizers(deepfm, [user_embedding_table], sparse_optimizer)
+
+    loader = RatingsBatchLoader(ratings, movie_metadata_table, batch_size=batch_size, drop_last=True, seed=rank)
+    # every worker has to run the same number of steps, or the all-reduce of the longest shard would hang
+    num_steps = torch.tensor(len(loader))
+    dist.all_reduce(num_steps, op=dist.ReduceOp.MIN)
+    num_steps = int(num_steps)
+    if max_steps is not None:
+        num_steps = min(num_steps, max_steps)
+
+    dist.barrier()
+    start_time = time.perf_counter()
+    for epoch in range(epochs):
+        for step, (user_index, _, movie_vectors, rating) in enumerate(loader):
+            if step == num_steps:
+                break
+            predictions = ddp_deepfm(movie_vectors.float(), user_embedding_table(user_index)).squeeze(-1)
+            loss = F.mse_loss(predictions, (rating >= 7).float())
+
+            for optim in optims:
+                optim.zero_grad()
+            loss.backward()
+            for optim in optims:
+                optim.step()
+
+            if rank == 0 and step % 100 == 0:
+                print(f"epoch {epoch} step {step}/{num_steps} | loss {loss.item():.4f}")
+    dist.barrier()
+    elapsed = time.perf_counter() - start_time
+
+    # reassemble the full user embedding table on rank 0 (shards differ in size by at most one row)
+    max_local_users = (len(ratings.user_ids) + world_size - 1) // world_size
+    local = torch.zeros(max_local_users, USER_VECTOR_SIZE)
+    local[:num_local_users] = user_embedding_table.weight.detach()
+    gathered = [torch.zeros_like(local) for _ in range(world_size)] if rank == 0 else None
+    dist.gather(local, gathered, dst=0)
+
+    if rank == 0:
+        user_embeddings = torch.zeros(len(ratings.user_ids), USER_VECTOR_SIZE)
+        for shard_rank, shard_embeddings in enumerate(gathered):
+            rows = user_embeddings[shard_rank::world_size]
+            user_embeddings[shard_rank::world_size] = shard_embeddings[:len(rows)]
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, deepfm, movie_metadata_table.movie_vector_size, user_embeddings, ratings.user_ids)
+
+        samples = world_size * num_steps * epochs * batch_size
+        results["elapsed"] = elapsed
+        results["samples_per_sec"] = samples / elapsed
+
+    dist.destroy_process_group()
+
+def train_distributed(
+    world_size=None,
+    train_user_ids=None,
+    train_movie_ids=None,
+    batch_size=1024,
+    epochs=1,
+    max_steps=None,
+    sparse_optimizer="sparse_adam",
+    checkpoint_path="deepfm_checkpoint.pt",
+):
+    """
+    Launch `world_size` training workers on this machine (defaults to one per core) and wait for them.
+    Returns a dict with the wall-clock time and the aggregate samples/sec.
+    """
+    world_size = world_size or os.cpu_count() or 1
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+
+    feature_store_dir = "../data/feature_store"
+    if os.path.exists(feature_store_dir):
+        # each worker maps the same files, so the pages are shared through the page cache
+        movie_table_source = feature_store_dir
+    else:
+        movie_table_source = load_movie_metadata_table()
+        movie_table_source.movie_matrix.share_memory_()
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(
+            train_worker,
+            args=(world_size, movie_table_source, train_user_ids, train_movie_ids, batch_size, epochs, max_steps, sparse_optimizer, checkpoint_path, results),
+            nprocs=world_size,
+        )
+        return dict(results)
+
+def scaling_report(worker_counts=(1, 2, 4, 8), batch_size=1024, max_steps=200):
+    for world_size in worker_counts:
+        results = train_distributed(world_size, batch_size=batch_size, max_steps=max_steps, checkpoint_path=None)
+        print(f"{world_size} worker(s): {results['samples_per_sec']:,.0f} samples/sec ({results['elapsed']:.1f}s)")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "scaling":
+        scaling_report()
+    else:
+        train_distributed()
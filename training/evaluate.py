@@ -0,0 +1,236 @@
+import time
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from recommender import load_checkpoint, load_mlp_checkpoint, load_movie_metadata_table, load_ratings
+from ratings_dataset import load_split_ids
+
+"""
+Offline evaluation on held-out users.
+
+Each held-out user's ratings are split into a history half and an evaluation half. For DeepFM and the HL-Gauss MLP
+the user vectors are folded in from the history (the model is frozen and only the new users' embedding rows are fit).
+Every user's evaluation ratings plus a sample of unrated movies are then scored in large batches, and
+RMSE, AUC, NDCG@k and recall@k are computed on padded [num_users, items] tensors, without per-user Python loops.
+
+A rating >= 7 counts as relevant, the same reward train_loop uses. Sampled unrated movies count as not relevant
+(a sample may occasionally hit a movie the user rated; at catalogue scale that is rare enough to ignore).
+
+To evaluate on users the model has not seen, train with `train_loop(train_user_ids=load_split_ids("../data/user_training_set.json"))`.
+"""
+
+@contextmanager
+def timed(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+def group_positions(group: torch.Tensor, num_groups: int):
+    """
+    For a sorted group-id tensor, returns each element's position within its group and the group sizes.
+    """
+    counts = torch.bincount(group, minlength=num_groups)
+    offsets = torch.cumsum(counts, 0) - counts
+    return torch.arange(len(group)) - offsets[group], counts
+
+def build_eval_pairs(ratings, num_movies, history_fraction=0.5, max_rated_per_user=200, num_negatives=100, seed=0):
+    """
+    :returns: a dict with
+     - `num_users`
+     - `history`: (user, movie, rating) tensors used to fold in user vectors
+     - `eval`: (user, movie, rating) tensors sorted by user; sampled unrated movies have rating 0
+    """
+    generator = torch.Generator().manual_seed(seed)
+    user_ids, user = torch.unique(torch.from_numpy(np.asarray(ratings.user_index)).long(), return_inverse=True)
+    movie = torch.from_numpy(np.asarray(ratings.movie_index)).long()
+    rating = torch.from_numpy(np.asarray(ratings.rating)).long()
+    num_users = len(user_ids)
+
+    # shuffle each user's ratings: sort by (user, random key)
+    order = torch.from_numpy(np.lexsort((torch.rand(len(user), generator=generator).numpy(), user.numpy())))
+    user, movie, rating = user[order], movie[order], rating[order]
+    position, counts = group_positions(user, num_users)
+    num_history = (counts.float() * history_fraction).long()
+    is_history = position < num_history[user]
+    is_eval = ~is_history & (position - num_history[user] < max_rated_per_user)
+
+    negative_user = torch.arange(num_users).repeat_interleave(num_negatives)
+    negative_movie = torch.randint(0, num_movies, (len(negative_user),), generator=generator)
+
+    eval_user = torch.cat([user[is_eval], negative_user])
+    eval_movie = torch.cat([movie[is_eval], negative_movie])
+    eval_rating = torch.cat([rating[is_eval], torch.zeros_like(negative_user)])
+    eval_order = torch.argsort(eval_user, stable=True)
+
+    return {
+        "num_users": num_users,
+        "user_ids": user_ids,
+        "history": (user[is_history], movie[is_history], rating[is_history]),
+        "eval": (eval_user[eval_order], eval_movie[eval_order], eval_rating[eval_order]),
+    }
+
+def deepfm_fold_in_loss(deepfm, movie_vectors, user_vectors, rating):
+    return F.mse_loss(deepfm(movie_vectors, user_vectors).squeeze(-1), (rating >= 7).float())
+
+def mlp_fold_in_loss(loss_fn):
+    def loss(mlp, movie_vectors, user_vectors, rating):
+        return loss_fn(mlp(torch.cat([movie_vectors, user_vectors], dim=-1)), rating)
+    return loss
+
+def fold_in_user_vectors(model, movie_metadata_table, history, num_users, init_vector, epochs=5, lr=0.05, batch_size=65536, loss=deepfm_fold_in_loss):
+    """
+    Fit embeddings for users the model has not seen, with the model's weights frozen.
+    `loss(model, movie_vectors, user_vectors, rating)` is the training objective (DeepFM's by default).
+    All users are fit together; each step only touches the rows of the users in the batch.
+    """
+    user, movie, rating = history
+    user_embedding_table = nn.Embedding(num_users, init_vector.shape[-1], sparse=True)
+    with torch.no_grad():
+        user_embedding_table.weight.copy_(init_vector.expand(num_users, -1))
+    optim = torch.optim.SparseAdam(user_embedding_table.parameters(), lr=lr)
+
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    model.requires_grad_(False)
+    for _ in range(epochs):
+        order = torch.randperm(len(user))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            movie_vectors = movie_metadata_table.lookup(movie[batch]).float()
+            batch_loss = loss(model, movie_vectors, user_embedding_table(user[batch]), rating[batch])
+            optim.zero_grad()
+            batch_loss.backward()
+            optim.step()
+    for p, flag in zip(model.parameters(), requires_grad):
+        p.requires_grad_(flag)
+    return user_embedding_table.weight.detach()
+
+def deepfm_scorer(deepfm, movie_metadata_table, user_vectors):
+    # movie tower computed once for the catalogue; each batch only runs the user side
+    deepfm.cache_movies(movie_metadata_table.lookup, len(movie_metadata_table.movie_ids))
+    def score(user, movie):
+        return deepfm.score_movies(user_vectors[user], movie.unsqueeze(-1)).squeeze(-1)
+    return score
+
+def mlp_scorer(mlp, loss_fn, movie_metadata_table, user_vectors):
+    # the HL-Gauss MLP takes [movie vector, user embedding]; the expected value of its bin distribution is the rating
+    def score(user, movie):
+        logits = mlp(torch.cat([movie_metadata_table.lookup(movie).float(), user_vectors[user]], dim=-1))
+        return loss_fn.predict(logits)
+    return score
+
+def lincb_scorer(lincb, movie_metadata_table):
+    def score(user, movie):
+        return lincb(movie_metadata_table.lookup(movie).float())
+    return score
+
+def evaluate(score_fn, pairs, k_values=(10, 50), batch_size=65536, predicts_rating=False):
+    """
+    Score the evaluation pairs with `score_fn(user, movie) -> scores` and compute the metrics.
+    RMSE is against relevance (0 / 1), or against the rating itself if `predicts_rating`.
+    Returns a dict with the metrics and a dict with the time spent on each step.
+    """
+    timings = {}
+    user, movie, rating = pairs["eval"]
+    num_users = pairs["num_users"]
+
+    with timed(timings, "scoring"), torch.no_grad():
+        scores = torch.cat([
+            score_fn(user[start:start + batch_size], movie[start:start + batch_size]).float()
+            for start in range(0, len(user), batch_size)
+        ])
+
+    metrics = {}
+    relevant = rating >= 7
+    with timed(timings, "rmse"):
+        rated = rating > 0
+        target = rating if predicts_rating else relevant
+        metrics["rmse"] = F.mse_loss(scores[rated], target[rated].float()).sqrt().item()
+
+    with timed(timings, "padding"):
+        # [num_users, max items per user]; padding slots have score -inf and are not valid
+        position, counts = group_positions(user, num_users)
+        padded_scores = torch.full((num_users, int(counts.max())), float("-inf"))
+        padded_scores[user, position] = scores
+        padded_relevant = torch.zeros(padded_scores.shape, dtype=torch.bool)
+        padded_relevant[user, position] = relevant
+        valid = torch.zeros(padded_scores.shape, dtype=torch.bool)
+        valid[user, position] = True
+        num_relevant = padded_relevant.sum(dim=1)
+
+    with timed(timings, "auc"):
+        # rank-sum (Mann-Whitney) AUC; padding sorts first, so shift ranks down by the amount of padding
+        ranks = padded_scores.argsort(dim=1).argsort(dim=1).float() + 1 - (~valid).sum(dim=1, keepdim=True)
+        num_irrelevant = counts - num_relevant
+        has_both = (num_relevant > 0) & (num_irrelevant > 0)
+        rank_sum = (ranks * padded_relevant).sum(dim=1)
+        auc = (rank_sum - num_relevant * (num_relevant + 1) / 2) / (num_relevant * num_irrelevant)
+        metrics["auc"] = auc[has_both].mean().item()
+
+    for k in k_values:
+        with timed(timings, f"ndcg/recall@{k}"):
+            k_ = min(k, padded_scores.shape[1])
+            top_k = padded_scores.topk(k_, dim=1).indices
+            gains = padded_relevant.float()
+            top_k_gains = gains.gather(1, top_k)
+            discounts = 1 / torch.log2(torch.arange(k_) + 2.0)
+            dcg = (top_k_gains * discounts).sum(dim=1)
+            idcg = (gains.sort(dim=1, descending=True).values[:, :k_] * discounts).sum(dim=1)
+            has_relevant = num_relevant > 0
+            metrics[f"ndcg@{k}"] = (dcg[has_relevant] / idcg[has_relevant]).mean().item()
+            metrics[f"recall@{k}"] = (top_k_gains.sum(dim=1)[has_relevant] / num_relevant[has_relevant]).mean().item()
+
+    return metrics, timings
+
+def evaluate_deepfm(checkpoint_path="deepfm_checkpoint.pt", test_users_file="../data/user_test_set.json", **pair_kwargs):
+    timings = {}
+    with timed(timings, "load"):
+        deepfm, checkpoint = load_checkpoint(checkpoint_path)
+        movie_metadata_table = load_movie_metadata_table()
+        ratings = load_ratings(user_ids=load_split_ids(test_users_file))
+    with timed(timings, "pairs"):
+        pairs = build_eval_pairs(ratings, len(movie_metadata_table.movie_ids), **pair_kwargs)
+    with timed(timings, "fold_in"):
+        init_vector = checkpoint["user_embeddings"].mean(dim=0)
+        user_vectors = fold_in_user_vectors(deepfm, movie_metadata_table, pairs["history"], pairs["num_users"], init_vector)
+
+    metrics, metric_timings = evaluate(deepfm_scorer(deepfm, movie_metadata_table, user_vectors), pairs)
+    timings.update(metric_timings)
+    print_results(pairs, metrics, timings)
+    return metrics, timings
+
+def evaluate_mlp(checkpoint_path="mlp_checkpoint.pt", test_users_file="../data/user_test_set.json", **pair_kwargs):
+    timings = {}
+    with timed(timings, "load"):
+        mlp, loss_fn, checkpoint = load_mlp_checkpoint(checkpoint_path)
+        movie_metadata_table = load_movie_metadata_table()
+        ratings = load_ratings(user_ids=load_split_ids(test_users_file))
+    with timed(timings, "pairs"):
+        pairs = build_eval_pairs(ratings, len(movie_metadata_table.movie_ids), **pair_kwargs)
+    with timed(timings, "fold_in"):
+        init_vector = checkpoint["user_embeddings"].mean(dim=0)
+        user_vectors = fold_in_user_vectors(
+            mlp, movie_metadata_table, pairs["history"], pairs["num_users"], init_vector, loss=mlp_fold_in_loss(loss_fn),
+        )
+
+    metrics, metric_timings = evaluate(mlp_scorer(mlp, loss_fn, movie_metadata_table, user_vectors), pairs, predicts_rating=True)
+    timings.update(metric_timings)
+    print_results(pairs, metrics, timings)
+    return metrics, timings
+
+def print_results(pairs, metrics, timings):
+    print(f"evaluated {pairs['num_users']} users, {len(pairs['eval'][0])} (user, movie) pairs")
+    for name, value in metrics.items():
+        print(f"{name:>12}: {value:.4f}")
+    for name, seconds in timings.items():
+        print(f"{name:>12}: {seconds * 1000:10.1f} ms")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "mlp":
+        evaluate_mlp()
+    else:
+        evaluate_deepfm()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+import torch
+import transformers
+
+"""
+Fast-start checkpoint for the fine-tuned GPT-2 used by stream.py.
+
+The original checkpoint is a whole pickled module (`torch.save(gpt2, ...)`): loading it unpickles and copies every
+weight, and the tokenizer is fetched with `GPT2Tokenizer.from_pretrained`, which needs the hub (or its cache) and
+runs the slow Python BPE. `export_fast_checkpoint` converts it into a directory with
+ - model.safetensors + config.json: the state_dict, memory-mapped on load instead of unpickled and copied
+ - tokenizer.json (+ vocab files): the Rust fast tokenizer, loaded from local files only
+so app cold starts and worker respawns neither unpickle nor touch the network.
+
+Usage (from the training directory): `python fast_checkpoint.py` exports gpt-2-letterboxd-tune-000.pt,
+`python fast_checkpoint.py bench` compares the load times of the two formats.
+"""
+
+MODEL_PATH = "gpt-2-letterboxd-tune-000.pt"
+TOKENIZER_NAME = "openai-community/gpt2"
+
+def fast_checkpoint_dir(model_path):
+    # gpt-2-letterboxd-tune-000.pt -> gpt-2-letterboxd-tune-000/
+    return os.path.splitext(model_path)[0]
+
+def export_fast_checkpoint(model_path=MODEL_PATH, tokenizer_name=TOKENIZER_NAME, out_dir=None):
+    out_dir = out_dir or fast_checkpoint_dir(model_path)
+    model = torch.load(model_path, map_location="cpu", weights_only=False)
+    # safetensors; tied weights (lm_head / wte) are stored once
+    model.save_pretrained(out_dir, safe_serialization=True)
+    transformers.GPT2TokenizerFast.from_pretrained(tokenizer_name).save_pretrained(out_dir)
+    return out_dir
+
+def load_fast_checkpoint(checkpoint_dir, device="cpu"):
+    """
+    Returns (model in eval mode, fast tokenizer). Reads local files only.
+    """
+    model = transformers.AutoModelForCausalLM.from_pretrained(checkpoint_dir, local_files_only=True).to(device)
+    model.eval()
+    tokenizer = transformers.GPT2TokenizerFast.from_pretrained(checkpoint_dir, local_files_only=True)
+    return model, tokenizer
+
+def load_legacy_checkpoint(model_path, tokenizer_name=TOKENIZER_NAME, device="cpu"):
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    tokenizer = transformers.GPT2Tokenizer.from_pretrained(tokenizer_name)
+    return model, tokenizer
+
+def bench_load(model_path=MODEL_PATH, tokenizer_name=TOKENIZER_NAME):
+    for name, load in [
+        ("pickled module + hub tokenizer", lambda: load_legacy_checkpoint(model_path, tokenizer_name)),
+        ("safetensors + local fast tokenizer", lambda: load_fast_checkpoint(fast_checkpoint_dir(model_path))),
+    ]:
+        start = time.perf_counter()
+        load()
+        print(f"{name:>36}: {time.perf_counter() - start:.2f}s")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_load()
+    else:
+        print(f"wrote {export_fast_checkpoint()}")
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+"""
+Binary, memory-mapped feature store.
+
+A feature store is a directory holding:
+ - `manifest.json`: format version, row count, and the dtype/shape of every block
+ - `movie_ids.json`: the ID index (row i of every block belongs to movie_ids[i])
+ - one `.npy` file per block (fixed dtype, C-contiguous)
+ - optionally, shared blocks that are not indexed by movie (e.g. quantization scales and codebooks)
+
+Blocks are opened with `np.load(..., mmap_mode='c')`, so opening a store is cheap and
+every process that opens the same store shares the same physical pages through the OS page cache.
+Copy-on-write mode means a process that writes into a block only changes its own private copy.
+"""
+
+FEATURE_STORE_VERSION = 4
+
+
+def write_feature_store(out_dir: str, movie_ids: list, blocks: dict, shared_blocks: dict = None, extra: dict = None, version: int = FEATURE_STORE_VERSION):
+    """
+    Write `blocks` (name -> numpy array with one row per movie) and `shared_blocks`
+    (name -> numpy array of any shape) to `out_dir`.
+    Other stores built on this layout (e.g. the movie catalogue) pass their own format `version`.
+    The store is written to a temporary directory first and then moved into place,
+    so a reader never observes a half-written store.
+    """
+    tmp_dir = out_dir.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    manifest = {
+        "version": version,
+        "num_rows": len(movie_ids),
+        "blocks": {},
+        "shared_blocks": {},
+        **(extra or {}),
+    }
+    for name, array in blocks.items():
+        assert array.shape[0] == len(movie_ids), f"Block {name} has {array.shape[0]} rows, expected {len(movie_ids)}"
+    for kind, kind_blocks in [("blocks", blocks), ("shared_blocks", shared_blocks or {})]:
+        for name, array in kind_blocks.items():
+            array = np.ascontiguousarray(array)
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+            manifest[kind][name] = {
+                "file": f"{name}.npy",
+                "dtype": str(array.dtype),
+                "shape": list(array.shape),
+            }
+
+    with open(os.path.join(tmp_dir, "movie_ids.json"), "w") as f:
+        json.dump(movie_ids, f)
+    # the manifest is written last; its presence marks the store as complete
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+
+def open_feature_store(store_dir: str, version: int = FEATURE_STORE_VERSION, compile_command: str = "python movie_metadata_table.py"):
+    """
+    Open a feature store written by `write_feature_store`.
+    `version` is the expected format version and `compile_command` the command that rebuilds the store.
+
+    :returns:
+     - `manifest`: the parsed manifest
+     - `movie_ids`: the ID index
+     - `blocks`: name -> memory-mapped numpy array, for both per-movie and shared blocks
+    """
+    with open(os.path.join(store_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != version:
+        raise ValueError(
+            f"Feature store at {store_dir} has version {manifest.get('version')}, "
+            f"expected {version}. Recompile it with `{compile_command}`."
+        )
+
+    with open(os.path.join(store_dir, "movie_ids.json"), "r") as f:
+        movie_ids = json.load(f)
+
+    blocks = {}
+    for name, info in [*manifest["blocks"].items(), *manifest["shared_blocks"].items()]:
+        array = np.load(os.path.join(store_dir, info["file"]), mmap_mode="c")
+        assert str(array.dtype) == info["dtype"] and list(array.shape) == info["shape"], f"Block {name} does not match the manifest"
+        blocks[name] = array
+
+    return manifest, movie_ids, blocks
+
+
+def encode_strings(strings):
+    """
+    Variable-length strings as a block pair: (int64 offsets [n + 1], uint8 UTF-8 blob).
+    Non-string values (e.g. NaN) are stored as empty strings.
+    """
+    encoded = [value.encode("utf-8") if type(value) is str else b"" for value in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def decode_strings(offsets, blob, rows):
+    """
+    Decode the strings at `rows` of a block pair written by `encode_strings`.
+    """
+    return [bytes(blob[offsets[row]:offsets[row + 1]]).decode("utf-8") for row in rows]
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+from feature_store import write_feature_store, open_feature_store, encode_strings, decode_strings
+from title_search import TitleSearchIndex
+
+"""
+Columnar movie catalogue for the Streamlit app.
+
+`compile_catalogue` reads only the columns the app uses from movie_data.csv and writes them in the feature store
+layout (memory-mapped .npy blocks + manifest):
+ - numeric columns as typed arrays (int16 year / runtime with -1 for missing, float32 vote count / popularity, and
+   float64 vote_average: the prompt prints it with 2 decimals, which float32 rounding would change, e.g. 6.675 -> "6.68")
+ - text columns as one UTF-8 byte blob plus int64 offsets per column
+ - the title search index (`title_search.TitleSearchIndex`), as `title_index.*` shared blocks
+
+`MovieCatalogue` decodes only the titles up front (labels for the sidebar and the rating inputs). Every other text column
+stays on disk and is decoded for the requested movies only, so a Streamlit worker holds the titles and a few
+small numeric arrays in RAM rather than the whole CSV.
+"""
+
+CATALOGUE_VERSION = 3
+COMPILE_COMMAND = "python movie_catalogue.py"
+
+NUMERIC_COLUMNS = {
+    'year_released': np.int16,
+    'runtime': np.int16,
+    'vote_average': np.float64,
+    'vote_count': np.float32,
+    'popularity': np.float32,
+}
+# int columns store missing values as -1
+INT_MISSING = -1
+TEXT_COLUMNS = ['movie_title', 'genres', 'production_countries', 'spoken_languages', 'overview']
+
+def compile_catalogue(movie_data_file, out_dir):
+    df = pd.read_csv(movie_data_file, usecols=['movie_id', *NUMERIC_COLUMNS, *TEXT_COLUMNS])
+    # movies without a release year are not shown in the app
+    df = df.dropna(subset=['year_released'])
+
+    blocks = {}
+    for name, dtype in NUMERIC_COLUMNS.items():
+        column = df[name]
+        if np.issubdtype(dtype, np.integer):
+            column = column.fillna(INT_MISSING)
+        blocks[name] = column.to_numpy().astype(dtype)
+    shared_blocks = {}
+    for name in TEXT_COLUMNS:
+        shared_blocks[f'{name}.offsets'], shared_blocks[f'{name}.utf8'] = encode_strings(df[name])
+    title_index = TitleSearchIndex.build(df['movie_title'].tolist(), df['vote_count'], df['popularity'])
+    for name, array in title_index.arrays().items():
+        shared_blocks[f'title_index.{name}'] = array
+
+    write_feature_store(out_dir, df['movie_id'].tolist(), blocks, shared_blocks, version=CATALOGUE_VERSION)
+
+class MovieCatalogue:
+    def __init__(self, store_dir):
+        manifest, movie_ids, blocks = open_feature_store(store_dir, CATALOGUE_VERSION, COMPILE_COMMAND)
+        self.movie_ids = movie_ids
+        self.movie_id_index = pd.Index(movie_ids)
+        # name -> memory-mapped array, one row per movie
+        self.columns = {name: blocks[name] for name in NUMERIC_COLUMNS}
+        # name -> (offsets, utf-8 blob), both memory-mapped
+        self.text_columns = {name: (blocks[f'{name}.offsets'], blocks[f'{name}.utf8']) for name in TEXT_COLUMNS}
+        self.titles = self.text('movie_title', range(len(movie_ids)))
+        self.title_index = TitleSearchIndex.from_arrays({
+            name[len('title_index.'):]: array for name, array in blocks.items() if name.startswith('title_index.')
+        })
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def rows(self, movie_ids):
+        rows = self.movie_id_index.get_indexer(movie_ids)
+        if (rows < 0).any():
+            missing = pd.Index(movie_ids)[rows < 0]
+            raise KeyError(f"{len(missing)} unknown movie IDs, e.g. {list(missing[:5])}")
+        return rows
+
+    def search_titles(self, query, limit=50):
+        """
+        Rows of the titles containing `query` (case and accents ignored), most voted first.
+        """
+        return self.title_index.search(query, limit)
+
+    def text(self, name, rows):
+        """
+        Decode text column `name` for `rows` only. Missing values come back as empty strings.
+        """
+        return decode_strings(*self.text_columns[name], rows)
+
+    def record(self, movie_id):
+        """
+        All catalogue columns of one movie as a dict (the shape `format_movie_data_v2` reads).
+        Missing values are NaN, as in the CSV.
+        """
+        row = int(self.rows([movie_id])[0])
+        record = {}
+        for name, column in self.columns.items():
+            value = column[row].item()
+            if np.issubdtype(column.dtype, np.integer) and value == INT_MISSING:
+                value = np.nan
+            record[name] = value
+        for name in TEXT_COLUMNS:
+            value = self.text(name, [row])[0]
+            record[name] = value if value else np.nan
+        return record
+
+if __name__ == '__main__':
+    compile_catalogue("../data/movie_data.csv", "../data/catalogue")
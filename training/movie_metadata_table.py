@@ -1,63 +1,232 @@
 import pandas as pd
 import json
+import os
 import torch
 
+from feature_store import write_feature_store, open_feature_store
+from quantized_vectors import QUANTIZERS, load_quantized_vectors
+
+# precisions the fused movie matrix can be stored in
+FEATURE_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
 def vectorize_string_array(string):
     return [int(x) for x in string[1:-1].split(" ")]
 
+def build_metadata_tensor(df):
+    """
+    convert to tensor:
+    - popularity [scalar]
+    - runtime [scalar]
+    - vote_average [scalar]
+    - vote_count [scalar; log1p transform]
+    - year_released [scalar; converted to one-hot indicator of decade]
+    - // release_date_ordinal [scalar]
+    - genres_encoded [one-hot]
+    - production_countries_encoded [one-hot]
+    - spoken_languages_encoded [one-hot]
+
+    Returns the tensor and a dict of column name -> [start, end) within it.
+    """
+    genres_vectorized = torch.tensor(df['genres_encoded'].map(vectorize_string_array))
+    countries_vectorized = torch.tensor(df['production_countries_encoded'].map(vectorize_string_array))
+    lang_vectorized = torch.tensor(df['spoken_languages_encoded'].map(vectorize_string_array))
+
+    columns = [
+        ('popularity', torch.tensor(df['popularity']).unsqueeze(-1)),
+        ('runtime', torch.tensor(df['runtime']).unsqueeze(-1)),
+        ('vote_average', torch.tensor(df['vote_average']).unsqueeze(-1)),
+        ('vote_count', torch.tensor(df['vote_count']).unsqueeze(-1).log1p()),
+        ('genres', genres_vectorized),
+        ('production_countries', countries_vectorized),
+        ('spoken_languages', lang_vectorized),
+    ]
+    column_ranges = {}
+    start = 0
+    for name, column in columns:
+        column_ranges[name] = [start, start + column.shape[-1]]
+        start += column.shape[-1]
+
+    return torch.cat([column for _, column in columns], dim=-1), column_ranges
+
+def fuse_features(features, dtype=torch.float32, quantized=None):
+    """
+    Concatenate (name, tensor) feature groups into one contiguous matrix of `dtype`.
+    Returns the matrix and a dict of group name -> [start, end) columns within a looked-up movie vector;
+    `quantized` groups are not part of the matrix and follow the dense groups in that vector.
+    """
+    feature_columns = {}
+    start = 0
+    for name, feature in [*features, *(quantized or {}).items()]:
+        feature_columns[name] = [start, start + feature.shape[-1]]
+        start += feature.shape[-1]
+    movie_matrix = torch.cat([feature.to(dtype) for _, feature in features], dim=-1).contiguous()
+    return movie_matrix, feature_columns
+
+def load_nlp_vectors(nlp_vectors_file):
+    """
+    Load the overview/title vectors, either as float tensors from `nlp_vectors.pt`
+    or as quantized vectors from a directory written by `data/vectorizing/compress_nlp_vectors.py int8|pq`.
+    """
+    if os.path.isdir(nlp_vectors_file):
+        return load_quantized_vectors(nlp_vectors_file)
+    return torch.load(nlp_vectors_file)
+
+def split_features(movie_tensor, nlp_vectors):
+    """
+    Split the feature groups into dense (name, tensor) pairs, which go into the fused matrix,
+    and name -> quantized vectors, which are dequantized at lookup time.
+    """
+    features = [('movie_tensor', movie_tensor), ('overview_vectors', nlp_vectors['overview_vectors']), ('title_vectors', nlp_vectors['title_vectors'])]
+    dense = [(name, feature) for name, feature in features if torch.is_tensor(feature)]
+    quantized = {name: feature for name, feature in features if not torch.is_tensor(feature)}
+    return dense, quantized
+
+def compile_feature_store(movie_ids_file, movie_data_vectorized_file, nlp_vectors_file, out_dir, dtype='float32'):
+    """
+    One-time conversion of the CSV/pickle inputs into a binary feature store
+    that `MovieMetadataTable.from_feature_store` can memory-map.
+
+    `dtype` is one of FEATURE_DTYPES; float16 and bfloat16 halve the size of the store.
+    `nlp_vectors_file` may also be a directory of quantized vectors, which are stored as codes
+    and only dequantized for the rows a lookup gathers.
+    """
+    with open(movie_ids_file, 'r') as f:
+        movie_ids = json.load(f)
+    df = pd.read_csv(movie_data_vectorized_file)
+    movie_tensor, column_ranges = build_metadata_tensor(df)
+    dense, quantized = split_features(movie_tensor, load_nlp_vectors(nlp_vectors_file))
+
+    # the dense feature groups are stored pre-concatenated so a batch lookup is a single gather
+    movie_matrix, feature_columns = fuse_features(dense, dtype=FEATURE_DTYPES[dtype], quantized=quantized)
+
+    # numpy has no bfloat16, so bfloat16 matrices are stored as their raw 16-bit patterns
+    blocks = {'movie_matrix': movie_matrix.view(torch.int16).numpy() if dtype == 'bfloat16' else movie_matrix.numpy()}
+    shared_blocks = {}
+    for name, vectors in quantized.items():
+        for array_name, array in vectors.arrays().items():
+            (blocks if array_name == 'codes' else shared_blocks)[f'{name}.{array_name}'] = array
+
+    write_feature_store(
+        out_dir,
+        movie_ids,
+        blocks=blocks,
+        shared_blocks=shared_blocks,
+        extra={
+            'feature_columns': feature_columns,
+            'metadata_columns': column_ranges,
+            'movie_matrix_dtype': dtype,
+            'quantized_features': {name: vectors.quantization for name, vectors in quantized.items()},
+        },
+    )
+
 class MovieMetadataTable:
-    def __init__(self, movie_ids_file, movie_data_vectorized_file, nlp_vectors_file):
+    def __init__(self, movie_ids_file, movie_data_vectorized_file, nlp_vectors_file, dtype='float32'):
         with open(movie_ids_file, 'r') as f:
-            self.movie_ids = json.load(f)
-        self.movie_id_to_index = {movie_id: i for i, movie_id in enumerate(self.movie_ids)}
+            movie_ids = json.load(f)
         self.movie_metadata = pd.read_csv(movie_data_vectorized_file)
 
+        # shape: [270422, 32]
+        movie_tensor, self.metadata_columns = build_metadata_tensor(self.movie_metadata)
+        dense, quantized = split_features(movie_tensor, load_nlp_vectors(nlp_vectors_file))
+        movie_matrix, feature_columns = fuse_features(dense, dtype=FEATURE_DTYPES[dtype], quantized=quantized)
+        self._set_tensors(movie_ids, movie_matrix, feature_columns, quantized)
+
+    @classmethod
+    def from_feature_store(cls, store_dir):
         """
-        convert to tensor:
-        - popularity [scalar]
-        - runtime [scalar]
-        - vote_average [scalar]
-        - vote_count [scalar; log1p transform]
-        - year_released [scalar; converted to one-hot indicator of decade]
-        - // release_date_ordinal [scalar]
-        - genres_encoded [one-hot]
-        - production_countries_encoded [one-hot]
-        - spoken_languages_encoded [one-hot]
+        Open a feature store written by `compile_feature_store`.
+        Tensors are views over memory-mapped files, so this does not read the features into RAM.
         """
-        
-        # shape: [270422, 32]
-        df = self.movie_metadata
-        genres_vectorized = df['genres_encoded'].map(vectorize_string_array)
-        countries_vectorized = df['production_countries_encoded'].map(vectorize_string_array)
-        lang_vectorized = df['spoken_languages_encoded'].map(vectorize_string_array)
-        
-        self.movie_tensor = torch.cat([
-            torch.tensor(df['popularity']).unsqueeze(-1),
-            torch.tensor(df['runtime']).unsqueeze(-1),
-            torch.tensor(df['vote_average']).unsqueeze(-1),
-            torch.tensor(df['vote_count']).unsqueeze(-1).log1p(),
-            torch.tensor(genres_vectorized),
-            torch.tensor(countries_vectorized),
-            torch.tensor(lang_vectorized),
-        ], dim=-1)
-        nlp_vectors = torch.load(nlp_vectors_file)
-        self.overview_vectors = nlp_vectors['overview_vectors']
-        self.title_vectors = nlp_vectors['title_vectors']
-
-        self.movie_vector_size = (
-            self.movie_tensor.shape[-1] +
-            self.overview_vectors.shape[-1] +
-            self.title_vectors.shape[-1]
-        )
+        manifest, movie_ids, blocks = open_feature_store(store_dir)
+        table = cls.__new__(cls)
+        table.movie_metadata = None
+        table.metadata_columns = manifest['metadata_columns']
+        movie_matrix = torch.from_numpy(blocks['movie_matrix'])
+        if manifest['movie_matrix_dtype'] == 'bfloat16':
+            movie_matrix = movie_matrix.view(torch.bfloat16)
+        quantized = {}
+        for name, quantization in manifest['quantized_features'].items():
+            arrays = {key[len(name) + 1:]: array for key, array in blocks.items() if key.startswith(name + '.')}
+            quantized[name] = QUANTIZERS[quantization].from_arrays(arrays)
+        table._set_tensors(movie_ids, movie_matrix, manifest['feature_columns'], quantized)
+        return table
+
+    def to(self, dtype):
+        """
+        Return a table sharing this one's IDs whose movie matrix is converted to `dtype` (a copy in RAM).
+        """
+        table = MovieMetadataTable.__new__(MovieMetadataTable)
+        table.movie_metadata = self.movie_metadata
+        table.metadata_columns = self.metadata_columns
+        table._set_tensors(self.movie_ids, self.movie_matrix.to(FEATURE_DTYPES.get(dtype, dtype)).contiguous(), self.feature_columns, self.quantized_features)
+        return table
+
+    def _set_tensors(self, movie_ids, movie_matrix, feature_columns, quantized_features=None):
+        self.movie_ids = movie_ids
+        self.movie_id_to_index = {movie_id: i for i, movie_id in enumerate(self.movie_ids)}
+        # hash index used to encode whole columns of movie IDs at once
+        self.movie_id_index = pd.Index(self.movie_ids)
+
+        # [num_movies, movie_vector_size], contiguous; float32 unless the store was compiled with a 16-bit dtype
+        self.movie_matrix = movie_matrix
+        self.feature_columns = feature_columns
+        # name -> quantized vectors for feature groups stored as codes rather than in the fused matrix
+        self.quantized_features = quantized_features or {}
+        # the individual feature groups are column views into the fused matrix (or the quantized vectors)
+        for name in ['movie_tensor', 'overview_vectors', 'title_vectors']:
+            if name in self.quantized_features:
+                setattr(self, name, self.quantized_features[name])
+            else:
+                setattr(self, name, self.movie_matrix[:, slice(*feature_columns[name])])
+
+        self.movie_vector_size = self.movie_matrix.shape[-1] + sum(vectors.shape[1] for vectors in self.quantized_features.values())
+        if self.movie_ids:
+            # single movies and batches must have the same width, quantized groups included
+            assert self(self.movie_ids[0]).shape[-1] == self.movie_vector_size, "Single-movie lookups do not return movie_vector_size dims"
+
+    def encode(self, movie_ids):
+        """
+        Vectorized movie ID -> row index conversion for a whole column of IDs
+        (list, numpy array or pandas Series). Returns an int64 tensor.
+        """
+        indices = self.movie_id_index.get_indexer(movie_ids)
+        if (indices < 0).any():
+            missing = pd.Index(movie_ids)[indices < 0]
+            raise KeyError(f"{len(missing)} unknown movie IDs, e.g. {list(missing[:5])}")
+        return torch.from_numpy(indices).long()
+
+    def lookup(self, movie_indices: torch.Tensor):
+        """
+        Fetch the movie vectors for a pre-encoded int64 index tensor of any shape.
+        Rows are returned in the stored dtype; only the gathered batch needs casting.
+        Quantized feature groups are dequantized for the gathered rows only.
+        """
+        flat_indices = movie_indices.reshape(-1)
+        rows = torch.index_select(self.movie_matrix, 0, flat_indices)
+        if self.quantized_features:
+            rows = torch.cat([rows, *[vectors.gather(flat_indices).to(rows.dtype) for vectors in self.quantized_features.values()]], dim=-1)
+        return rows.view(*movie_indices.shape, -1)
 
     def __call__(self, movie_index):
         if type(movie_index) == str:
             movie_index = self.movie_id_to_index[movie_index]
-        elif type(movie_index) == list:
-            movie_index = [self.movie_id_to_index[movie_id] for movie_id in movie_index]
-
-        return torch.cat([
-            self.movie_tensor[movie_index],
-            self.overview_vectors[movie_index],
-            self.title_vectors[movie_index],
-        ], dim=-1)
\ No newline at end of file
+        if type(movie_index) == int:
+            # through lookup, so quantized groups are dequantized and appended as for a batch
+            return self.lookup(torch.tensor([movie_index]))[0]
+        if type(movie_index) == list and len(movie_index) > 0 and type(movie_index[0]) == str:
+            movie_index = self.encode(movie_index)
+
+        return self.lookup(torch.as_tensor(movie_index, dtype=torch.long))
+
+if __name__ == '__main__':
+    compile_feature_store(
+        movie_ids_file="../data/movie_ids.json",
+        movie_data_vectorized_file="../data/vectorizing/movie_data_vectorized.csv",
+        nlp_vectors_file="../data/vectorizing/nlp_vectors.pt",
+        out_dir="../data/feature_store",
+        dtype='float32',
+    )
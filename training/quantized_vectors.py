@@ -0,0 +1,131 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+"""
+Compressed storage for the sentence-embedding (overview / title) vectors.
+
+ - Int8Vectors: one int8 code per dimension plus a float32 scale per dimension (4x smaller than float32)
+ - ProductQuantizedVectors: each vector is split into `num_subspaces` sub-vectors, and each sub-vector is
+   replaced by the uint8 index of its nearest centroid in that subspace's 256-entry codebook
+   (384 / num_subspaces * 4x smaller than float32, e.g. 16x for 96 subspaces)
+
+Both only dequantize the rows passed to `gather`, so the full float32 matrix is never materialized.
+Each class exposes its data as named numpy arrays: `codes` has one row per vector and the rest are shared.
+"""
+
+class Int8Vectors:
+    quantization = "int8"
+
+    def __init__(self, codes: torch.Tensor, scale: torch.Tensor):
+        # [num_vectors, dims] int8, [dims] float32
+        self.codes = codes
+        self.scale = scale
+        self.shape = (codes.shape[0], codes.shape[1])
+
+    @staticmethod
+    def fit_scale(max_abs: np.ndarray):
+        """
+        Per-dimension symmetric scale from the per-dimension maximum absolute value.
+        """
+        return np.maximum(max_abs, 1e-12).astype(np.float32) / 127
+
+    @staticmethod
+    def encode(vectors: np.ndarray, scale: np.ndarray):
+        return np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+
+    def gather(self, indices: torch.Tensor):
+        return self.codes[indices].float() * self.scale
+
+    def arrays(self):
+        return {"codes": self.codes.numpy(), "scale": self.scale.numpy()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(torch.from_numpy(arrays["codes"]), torch.from_numpy(arrays["scale"]))
+
+class ProductQuantizedVectors:
+    quantization = "pq"
+
+    def __init__(self, codes: torch.Tensor, codebooks: torch.Tensor):
+        # [num_vectors, num_subspaces] uint8, [num_subspaces, num_centroids, subspace_dims] float32
+        self.codes = codes
+        self.codebooks = codebooks
+        self.subspace_index = torch.arange(codebooks.shape[0])
+        self.shape = (codes.shape[0], codebooks.shape[0] * codebooks.shape[2])
+
+    @staticmethod
+    def fit_codebooks(sample: np.ndarray, num_subspaces: int, num_centroids: int = 256, iterations: int = 20, seed: int = 0):
+        """
+        k-means in every subspace at once (batched over subspaces) on a sample of the vectors.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        x = torch.from_numpy(sample).float()
+        assert x.shape[1] % num_subspaces == 0, "vector dims must be divisible by num_subspaces"
+        # [num_subspaces, num_samples, subspace_dims]
+        x = x.view(x.shape[0], num_subspaces, -1).transpose(0, 1).contiguous()
+        codebooks = x[:, torch.randperm(x.shape[1], generator=generator)[:num_centroids]].clone()
+
+        for _ in range(iterations):
+            assignments = torch.cdist(x, codebooks).argmin(dim=-1)
+            sums = torch.zeros_like(codebooks).scatter_add_(1, assignments.unsqueeze(-1).expand_as(x), x)
+            counts = torch.zeros(codebooks.shape[:2]).scatter_add_(1, assignments, torch.ones(assignments.shape))
+            # empty clusters keep their previous centroid
+            nonempty = counts > 0
+            codebooks[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(-1)
+        return codebooks.numpy()
+
+    @staticmethod
+    def encode(vectors: np.ndarray, codebooks: np.ndarray):
+        num_subspaces = codebooks.shape[0]
+        x = torch.from_numpy(vectors).float()
+        x = x.view(x.shape[0], num_subspaces, -1).transpose(0, 1)
+        return torch.cdist(x, torch.from_numpy(codebooks)).argmin(dim=-1).T.to(torch.uint8).numpy()
+
+    def gather(self, indices: torch.Tensor):
+        codes = self.codes[indices].long()
+        # [..., num_subspaces, subspace_dims] -> [..., dims]
+        return self.codebooks[self.subspace_index, codes].flatten(-2)
+
+    def arrays(self):
+        return {"codes": self.codes.numpy(), "codebooks": self.codebooks.numpy()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(torch.from_numpy(arrays["codes"]), torch.from_numpy(arrays["codebooks"]))
+
+QUANTIZERS = {
+    Int8Vectors.quantization: Int8Vectors,
+    ProductQuantizedVectors.quantization: ProductQuantizedVectors,
+}
+
+def save_quantized_vectors(out_dir, vectors: dict):
+    """
+    Save name -> quantized vectors as `{name}.{array}.npy` files plus a manifest.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {}
+    for name, quantized in vectors.items():
+        arrays = quantized.arrays()
+        for array_name, array in arrays.items():
+            np.save(os.path.join(out_dir, f"{name}.{array_name}.npy"), array)
+        manifest[name] = {"quantization": quantized.quantization, "arrays": list(arrays.keys())}
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+def load_quantized_vectors(vectors_dir):
+    """
+    Load (memory-mapped) vectors written by `save_quantized_vectors`.
+    """
+    with open(os.path.join(vectors_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    vectors = {}
+    for name, info in manifest.items():
+        arrays = {
+            array_name: np.load(os.path.join(vectors_dir, f"{name}.{array_name}.npy"), mmap_mode="c")
+            for array_name in info["arrays"]
+        }
+        vectors[name] = QUANTIZERS[info["quantization"]].from_arrays(arrays)
+    return vectors
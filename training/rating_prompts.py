@@ -0,0 +1,128 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Token-level prompt assembly for the fine-tuned GPT-2 rating model.
+
+The model was trained on fragments tokenized one at a time (see `MovieRatingDataset` in lang_model.ipynb):
+    "---\n{movie}\n---\nRating:"  " {rating}"  " / 10\n"
+so a prompt is the concatenation of those fragments' token IDs, and the fragments can be cached:
+ - `RatingPromptCache` formats and tokenizes a movie once and keeps its IDs in an LRU of `max_movies` movies,
+   so a submit does no JSON parsing and no tokenization for movies it has seen
+ - rating and suffix fragments are tokenized once per cache
+`build_prompt` ends with the queried movie's rating slot ("Rating:") and, if the history does not fit the context
+window, drops the oldest rated movies rather than cutting the end of the prompt.
+"""
+
+MOVIE_PREFIX = "---\n"
+RATING_SLOT = "\n---\nRating:"
+RATING_SUFFIX = " / 10\n"
+RATING_VALUES = list(range(1, 11))
+
+nan2list = lambda x: x if type(x) is str else '[]'
+
+def format_movie_data_v2(movie_data): # , user_rating, user_review):
+    release_yr = movie_data.get("year_released", None)
+    title_fmt = movie_data.get("movie_title", "N/A") + (f" ({release_yr})" if release_yr else "")
+    genre_fmt = ' and '.join([x.lower() for x in json.loads(nan2list(movie_data.get('genres', "[]")))])
+    runtime = movie_data.get('runtime', None)
+    if runtime is not None and not np.isnan(runtime):
+        hours = int(runtime // 60)
+        minutes = int(runtime % 60)
+        runtime_fmt = f"{hours}h {minutes}m"
+    else:
+        runtime_fmt = "N/A"
+
+    avg_rating = movie_data.get('vote_average')
+    votes = movie_data.get('vote_count')
+    if votes is not None and not np.isnan(votes) and votes > 0:
+        votes = int(votes)
+        avg_rating_fmt = f"{avg_rating:.2f} ({votes} vote(s))"
+    else:
+        avg_rating_fmt = "N/A"
+
+    production_countries_fmt = ' and '.join(json.loads(nan2list(movie_data.get('production_countries', "[]")))) or 'N/A'
+    languages_fmt = ' and '.join(json.loads(nan2list(movie_data.get('spoken_languages', "[]")))) or 'N/A'
+    overview = movie_data.get("overview", "N/A")
+
+    return f"""
+Title: {title_fmt}
+Genres: {genre_fmt}
+Runtime: {runtime_fmt}
+Average rating: {avg_rating_fmt}
+Production countries: {production_countries_fmt}
+Languages: {languages_fmt}
+Overview: {overview}
+""".strip()
+
+class RatingPromptCache:
+    def __init__(self, tokenizer, movie_record, max_movies=4096):
+        """
+        `movie_record(movie_id)` returns the dict `format_movie_data_v2` reads (e.g. `MovieCatalogue.record`).
+        """
+        self.tokenizer = tokenizer
+        self.movie_record = movie_record
+        self.max_movies = max_movies
+        # movie_id -> int64 token IDs of MOVIE_PREFIX + formatted movie + RATING_SLOT, least recently used first
+        self.movies = OrderedDict()
+        # the app shares one cache between sessions, which run on different threads
+        self.lock = threading.Lock()
+        self.rating_ids = {rating: self.encode(f" {rating}") for rating in RATING_VALUES}
+        self.suffix_ids = self.encode(RATING_SUFFIX)
+
+    def encode(self, text):
+        return np.array(self.tokenizer(text).input_ids, dtype=np.int64)
+
+    def movie_ids(self, movie_id):
+        """
+        Token IDs of the movie block, ending with its (empty) rating slot.
+        """
+        with self.lock:
+            ids = self.movies.get(movie_id)
+            if ids is not None:
+                self.movies.move_to_end(movie_id)
+                return ids
+        ids = self.encode(MOVIE_PREFIX + format_movie_data_v2(self.movie_record(movie_id)) + RATING_SLOT)
+        with self.lock:
+            self.movies[movie_id] = ids
+            if len(self.movies) > self.max_movies:
+                self.movies.popitem(last=False)
+        return ids
+
+    def rated_ids(self, movie_id, rating):
+        """
+        Token IDs of the movie block followed by its rating.
+        """
+        return np.concatenate([self.movie_ids(movie_id), self.rating_ids[int(rating)], self.suffix_ids])
+
+    def build_history(self, history_movies, history_ratings, max_tokens=1024):
+        """
+        Token IDs of the rated history (oldest first), dropping the oldest movies until it fits in `max_tokens`.
+
+        :returns: (int64 token IDs, number of history movies kept)
+        """
+        blocks = []
+        total = 0
+        # newest first, so the history is cut at the oldest movie that no longer fits
+        for movie_id, rating in zip(reversed(history_movies), reversed(history_ratings)):
+            block = self.rated_ids(movie_id, rating)
+            if total + len(block) > max_tokens:
+                break
+            blocks.append(block)
+            total += len(block)
+        return np.concatenate([*reversed(blocks), np.zeros(0, dtype=np.int64)]), len(blocks)
+
+    def build_prompt(self, history_movies, history_ratings, query_movie, max_tokens=1024):
+        """
+        Token IDs of the rated history (oldest first) followed by the rating slot of `query_movie`.
+        The oldest history movies are dropped until the prompt fits in `max_tokens`.
+
+        :returns: (int64 token IDs, number of history movies kept)
+        """
+        # a queried movie longer than the context window keeps its end, where the rating slot is
+        query = self.movie_ids(query_movie)[-max_tokens:]
+        history, num_kept = self.build_history(history_movies, history_ratings, max_tokens - len(query))
+        return np.concatenate([history, query]), num_kept
@@ -0,0 +1,212 @@
+import copy
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from rating_prompts import RATING_VALUES
+
+"""
+Rating predictions from the fine-tuned GPT-2 with one forward pass.
+
+A prompt built by `RatingPromptCache.build_prompt` ends with the queried movie's "Rating:" slot, and the model was
+trained to continue it with one of the tokens " 1" ... " 10". Instead of `generate` + decode + `int()` parsing,
+`RatingScorer` runs the transformer once, takes the last position's hidden state and multiplies it with the output
+embedding rows of those 10 tokens only. The softmax over them is the rating distribution (the probability of the
+rating given that the model answers with a rating), and its mean is the expected rating.
+
+To rank many candidate movies for one user, `score_candidates` encodes the rated history once and reuses its
+`past_key_values` for padded batches of candidate blocks ("---\n{movie}\n---\nRating:"), so each candidate costs
+a forward pass over its own block rather than over the whole prompt. Candidates are right-padded: causal attention
+never lets a real token see the padding after it, so no attention mask is needed, and every candidate is read at
+its last real position. The history KV cache is repeated for each batch, which holds
+batch_size x (history + block) keys and values per layer; `batch_size` bounds that memory.
+
+In the app, a session's history only grows by a movie or two between submits. `predict_cached` keeps the KV cache
+of the session's rated history in a `HistoryKVCache`, keyed by the ordered (movie, rating) pairs, and on the next
+submit prefills only the movies after the longest cached common prefix (an edited rating crops the cache back to
+the movies before it). Once the history outgrows the context window its oldest movie is dropped, every position
+shifts and the cache cannot be reused, so that submit prefills in full.
+"""
+
+def crop_cache(past_key_values, num_tokens):
+    # a negative argument removes that many tokens; positive lengths are deprecated in recent transformers
+    excess = past_key_values.get_seq_length() - num_tokens
+    if excess > 0:
+        past_key_values.crop(-excess)
+
+class HistoryKVCache:
+    """
+    KV caches of rated-history prompts for one session, least recently used first, bounded by `max_bytes`.
+    """
+    def __init__(self, bytes_per_token, max_bytes=128 * 2**20):
+        self.bytes_per_token = bytes_per_token
+        self.max_bytes = max_bytes
+        # ((movie_id, rating), ...) -> (past_key_values, token offset of every movie block + the end)
+        self.entries = OrderedDict()
+
+    def num_bytes(self):
+        return sum(offsets[-1] for _, offsets in self.entries.values()) * self.bytes_per_token
+
+    def take(self, key):
+        """
+        Remove and return the cache sharing the most leading movies with `key`, cropped to them.
+
+        :returns: (past_key_values or None, token offsets of the reused movies)
+        """
+        best_key, best_length = None, 0
+        for entry_key in self.entries:
+            length = 0
+            while length < min(len(entry_key), len(key)) and entry_key[length] == key[length]:
+                length += 1
+            if length > best_length:
+                best_key, best_length = entry_key, length
+        if best_key is None:
+            return None, [0]
+        past_key_values, offsets = self.entries.pop(best_key)
+        crop_cache(past_key_values, offsets[best_length])
+        return past_key_values, offsets[:best_length + 1]
+
+    def put(self, key, past_key_values, offsets):
+        self.entries[key] = (past_key_values, offsets)
+        while self.entries and self.num_bytes() > self.max_bytes:
+            self.entries.popitem(last=False)
+
+class RatingScorer:
+    def __init__(self, model, prompt_cache):
+        self.model = model
+        self.prompt_cache = prompt_cache
+        for rating, ids in prompt_cache.rating_ids.items():
+            if len(ids) != 1:
+                raise ValueError(f"Rating {rating} is {len(ids)} tokens, expected one")
+        self.rating_token_ids = torch.tensor([int(prompt_cache.rating_ids[rating][0]) for rating in RATING_VALUES])
+        self.rating_values = torch.tensor(RATING_VALUES, dtype=torch.float32)
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def rating_logits(self, hidden):
+        """
+        Logits of the rating tokens for hidden states `hidden` [..., n_embd] -> [..., 10].
+        """
+        lm_head = self.model.get_output_embeddings()
+        logits = hidden @ lm_head.weight[self.rating_token_ids.to(hidden.device)].T
+        if lm_head.bias is not None:
+            logits = logits + lm_head.bias[self.rating_token_ids.to(hidden.device)]
+        return logits.float()
+
+    def distribution(self, logits):
+        """
+        :returns: (probabilities [..., 10] over RATING_VALUES, expected rating [...]), on the CPU
+        """
+        probs = torch.softmax(logits, dim=-1).cpu()
+        return probs, probs @ self.rating_values
+
+    @torch.no_grad()
+    def score_ids(self, input_ids):
+        """
+        Rating distribution after the prompt `input_ids` (1D token IDs ending with a rating slot).
+        """
+        input_ids = torch.as_tensor(np.asarray(input_ids), device=self.device).unsqueeze(0)
+        hidden = self.model.base_model(input_ids=input_ids).last_hidden_state[0, -1]
+        return self.distribution(self.rating_logits(hidden))
+
+    def predict(self, history_movies, history_ratings, query_movie):
+        """
+        Rating distribution of `query_movie` given the rated history (oldest first).
+
+        :returns: (probabilities [10] over RATING_VALUES, expected rating)
+        """
+        input_ids, _ = self.prompt_cache.build_prompt(
+            history_movies, history_ratings, query_movie, max_tokens=self.model.config.n_positions,
+        )
+        probs, expected = self.score_ids(input_ids)
+        return probs, float(expected)
+
+    @torch.no_grad()
+    def prefill(self, input_ids):
+        """
+        KV cache of the prompt `input_ids` (1D), or None for an empty prompt.
+        """
+        if len(input_ids) == 0:
+            return None
+        input_ids = torch.as_tensor(np.asarray(input_ids), device=self.device).unsqueeze(0)
+        return self.model.base_model(input_ids=input_ids, use_cache=True).past_key_values
+
+    @torch.no_grad()
+    def score_suffixes(self, past_key_values, suffixes, batch_size=16):
+        """
+        Rating logits [len(suffixes), 10] after each of `suffixes` (1D token IDs ending with a rating slot),
+        all continuing the prompt cached in `past_key_values` (None for no prompt).
+        """
+        lengths = np.array([len(suffix) for suffix in suffixes])
+        logits = torch.empty(len(suffixes), len(RATING_VALUES))
+        # similar lengths in a batch, so little of it is padding
+        order = np.argsort(lengths, kind="stable")
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            input_ids = np.zeros((len(batch), lengths[batch].max()), dtype=np.int64)
+            for row, index in enumerate(batch):
+                input_ids[row, :lengths[index]] = suffixes[index]
+            past = None
+            if past_key_values is not None:
+                past = copy.deepcopy(past_key_values)
+                past.batch_repeat_interleave(len(batch))
+            hidden = self.model.base_model(
+                input_ids=torch.from_numpy(input_ids).to(self.device), past_key_values=past, use_cache=past is not None,
+            ).last_hidden_state
+            last = hidden[torch.arange(len(batch)), torch.from_numpy(lengths[batch] - 1).to(self.device)]
+            logits[torch.from_numpy(batch)] = self.rating_logits(last).cpu()
+        return logits
+
+    def score_candidates(self, history_movies, history_ratings, candidate_movies, batch_size=16):
+        """
+        Rating distributions of every movie in `candidate_movies` given the same rated history (oldest first).
+        The history is truncated so that it fits in the context window with the longest candidate.
+
+        :returns: (probabilities [len(candidate_movies), 10] over RATING_VALUES, expected ratings [len(candidate_movies)])
+        """
+        max_tokens = self.model.config.n_positions
+        suffixes = [self.prompt_cache.movie_ids(movie_id)[-max_tokens:] for movie_id in candidate_movies]
+        history, _ = self.prompt_cache.build_history(
+            history_movies, history_ratings, max_tokens - max(len(suffix) for suffix in suffixes),
+        )
+        return self.distribution(self.score_suffixes(self.prefill(history), suffixes, batch_size))
+
+    def history_cache(self, max_bytes=128 * 2**20):
+        """
+        An empty `HistoryKVCache` for this model (one per session).
+        """
+        config = self.model.config
+        bytes_per_token = 2 * config.n_layer * config.n_embd * self.model.dtype.itemsize
+        return HistoryKVCache(bytes_per_token, max_bytes)
+
+    @torch.no_grad()
+    def predict_cached(self, history_cache, history_movies, history_ratings, query_movie):
+        """
+        `predict`, reusing and updating the KV cache of the rated history in `history_cache`.
+        """
+        max_tokens = self.model.config.n_positions
+        query = self.prompt_cache.movie_ids(query_movie)[-max_tokens:]
+        _, num_kept = self.prompt_cache.build_history(history_movies, history_ratings, max_tokens - len(query))
+        key = tuple(zip(history_movies, (int(rating) for rating in history_ratings)))[len(history_movies) - num_kept:]
+
+        past, offsets = history_cache.take(key)
+        new_blocks = [self.prompt_cache.rated_ids(movie_id, rating) for movie_id, rating in key[len(offsets) - 1:]]
+        for block in new_blocks:
+            offsets.append(offsets[-1] + len(block))
+        if new_blocks:
+            new_ids = torch.from_numpy(np.concatenate(new_blocks)).to(self.device).unsqueeze(0)
+            past = self.model.base_model(input_ids=new_ids, past_key_values=past, use_cache=True).past_key_values
+        if past is None:
+            probs, expected = self.score_ids(query)
+            return probs, float(expected)
+
+        query = torch.from_numpy(query).to(self.device).unsqueeze(0)
+        hidden = self.model.base_model(input_ids=query, past_key_values=past, use_cache=True).last_hidden_state[0, -1]
+        # back to the history only, for the next submit
+        crop_cache(past, offsets[-1])
+        history_cache.put(key, past, offsets)
+        probs, expected = self.distribution(self.rating_logits(hidden))
+        return probs, float(expected)
@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+"""
+Pre-encoded ratings dataset.
+
+`compile_ratings` parses `ratings_export.csv` once and writes it as three columnar arrays:
+ - `user_index.npy` [int32]: row in `user_ids.json`
+ - `movie_index.npy` [int32]: row in `movie_ids.json` (the same order as MovieMetadataTable)
+ - `rating.npy` [uint8]: rating_val, 1-10
+
+That is 9 bytes per rating instead of the hundreds of bytes pandas spends on Python string objects,
+and loading it is a few `np.load` calls instead of a CSV parse.
+"""
+
+RATINGS_DATASET_VERSION = 1
+
+def load_split_ids(split_file):
+    """
+    Load the IDs from a split written by `data/split_user_data.py` (records with a `username` field)
+    or `data/split_movie_data.py` (a plain list of movie IDs).
+    """
+    with open(split_file, 'r') as f:
+        split = json.load(f)
+    if len(split) > 0 and type(split[0]) == dict:
+        return [record['username'] for record in split]
+    return split
+
+def compile_ratings(ratings_file, movie_ids_file, out_dir, chunksize=1_000_000):
+    with open(movie_ids_file, 'r') as f:
+        movie_ids = json.load(f)
+    movie_id_index = pd.Index(movie_ids)
+
+    user_id_to_index = {}
+    user_index_chunks = []
+    movie_index_chunks = []
+    rating_chunks = []
+    num_dropped = 0
+
+    reader = pd.read_csv(
+        ratings_file,
+        usecols=['movie_id', 'rating_val', 'user_id'],
+        dtype={'movie_id': str, 'user_id': str},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        num_rows = len(chunk)
+        chunk = chunk.dropna()
+        movie_index = movie_id_index.get_indexer(chunk['movie_id'])
+        # ratings for movies that are not in the catalogue can't be looked up by MovieMetadataTable
+        keep = movie_index >= 0
+        num_dropped += num_rows - int(keep.sum())
+        chunk = chunk[keep]
+
+        # factorize per chunk, then only map the chunk's unique usernames through the global dict
+        codes, uniques = pd.factorize(chunk['user_id'])
+        global_codes = np.empty(len(uniques), dtype=np.int32)
+        for i, user_id in enumerate(uniques):
+            global_codes[i] = user_id_to_index.setdefault(user_id, len(user_id_to_index))
+
+        user_index_chunks.append(global_codes[codes])
+        movie_index_chunks.append(movie_index[keep].astype(np.int32))
+        rating_chunks.append(chunk['rating_val'].to_numpy().astype(np.uint8))
+
+    tmp_dir = out_dir.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    user_index = np.concatenate(user_index_chunks)
+    np.save(os.path.join(tmp_dir, 'user_index.npy'), user_index)
+    np.save(os.path.join(tmp_dir, 'movie_index.npy'), np.concatenate(movie_index_chunks))
+    np.save(os.path.join(tmp_dir, 'rating.npy'), np.concatenate(rating_chunks))
+    with open(os.path.join(tmp_dir, 'user_ids.json'), 'w') as f:
+        json.dump(list(user_id_to_index.keys()), f)
+    with open(os.path.join(tmp_dir, 'movie_ids.json'), 'w') as f:
+        json.dump(movie_ids, f)
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump({
+            'version': RATINGS_DATASET_VERSION,
+            'num_ratings': len(user_index),
+            'num_users': len(user_id_to_index),
+            'num_movies': len(movie_ids),
+            'num_dropped': num_dropped,
+        }, f, indent=2)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+class RatingsDataset:
+    def __init__(self, dataset_dir):
+        with open(os.path.join(dataset_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != RATINGS_DATASET_VERSION:
+            raise ValueError(
+                f"Ratings dataset at {dataset_dir} has version {manifest.get('version')}, "
+                f"expected {RATINGS_DATASET_VERSION}. Recompile it with `python ratings_dataset.py`."
+            )
+        with open(os.path.join(dataset_dir, 'user_ids.json'), 'r') as f:
+            self.user_ids = json.load(f)
+        with open(os.path.join(dataset_dir, 'movie_ids.json'), 'r') as f:
+            self.movie_ids = json.load(f)
+        self.user_id_index = pd.Index(self.user_ids)
+        self.movie_id_index = pd.Index(self.movie_ids)
+
+        self.user_index = np.load(os.path.join(dataset_dir, 'user_index.npy'), mmap_mode='c')
+        self.movie_index = np.load(os.path.join(dataset_dir, 'movie_index.npy'), mmap_mode='c')
+        self.rating = np.load(os.path.join(dataset_dir, 'rating.npy'), mmap_mode='c')
+
+    def __len__(self):
+        return len(self.rating)
+
+    def user_mask(self, user_ids):
+        """
+        Boolean mask over ratings made by any of `user_ids`.
+        Built with a per-user lookup table, so it is a single O(num_ratings) gather rather than an `isin` over strings.
+        """
+        selected = np.zeros(len(self.user_ids), dtype=bool)
+        indices = self.user_id_index.get_indexer(user_ids)
+        selected[indices[indices >= 0]] = True
+        return selected[self.user_index]
+
+    def movie_mask(self, movie_ids):
+        """
+        Boolean mask over ratings of any of `movie_ids`.
+        """
+        selected = np.zeros(len(self.movie_ids), dtype=bool)
+        indices = self.movie_id_index.get_indexer(movie_ids)
+        selected[indices[indices >= 0]] = True
+        return selected[self.movie_index]
+
+    def select(self, user_ids=None, movie_ids=None):
+        """
+        Return a copy of the dataset restricted to the given users and/or movies.
+        User and movie indices keep their meaning, so embedding tables can still be sized by `len(user_ids)`.
+        """
+        if user_ids is None and movie_ids is None:
+            return self
+        mask = np.ones(len(self), dtype=bool)
+        if user_ids is not None:
+            mask &= self.user_mask(user_ids)
+        if movie_ids is not None:
+            mask &= self.movie_mask(movie_ids)
+        return self.subset(mask)
+
+    def subset(self, mask):
+        """
+        Return a copy of the dataset with only the ratings selected by `mask` (a boolean or index array).
+        """
+        subset = RatingsDataset.__new__(RatingsDataset)
+        subset.__dict__.update(self.__dict__)
+        subset.user_index = self.user_index[mask]
+        subset.movie_index = self.movie_index[mask]
+        subset.rating = self.rating[mask]
+        return subset
+
+if __name__ == '__main__':
+    compile_ratings(
+        ratings_file="../data/ratings_export.csv",
+        movie_ids_file="../data/movie_ids.json",
+        out_dir="../data/ratings_dataset",
+    )
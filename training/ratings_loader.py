@@ -0,0 +1,93 @@
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Batch pipeline over a RatingsDataset.
+
+All ratings are held as tensors. An epoch shuffles by permuting indices, and a batch is a slice of the
+permutation followed by index_selects, so there is no per-row Python work. Batches are assembled
+(including the movie feature gather) by background threads while the model trains on the current
+batch; torch releases the GIL inside the gathers, so the threads overlap with the training step.
+"""
+
+class RatingsBatchLoader:
+    def __init__(
+        self,
+        ratings,
+        movie_metadata_table=None,
+        batch_size: int = 1024,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        num_workers: int = 2,
+        prefetch_batches: int = 4,
+        pin_memory: bool = False,
+        seed: int = None,
+    ):
+        """
+        :params:
+         - `ratings`: a RatingsDataset (or anything with `user_index`, `movie_index` and `rating` arrays)
+         - `movie_metadata_table`: if given, batches also contain the gathered movie vectors
+         - `num_workers`: background threads assembling batches. 0 assembles batches in the calling thread.
+         - `prefetch_batches`: how many batches may be assembled ahead of the consumer
+         - `pin_memory`: pin batch tensors so host->GPU copies can be non-blocking
+        """
+        # the stored int32 / uint8 columns (memory-mapped for a RatingsDataset); only gathered batches are widened
+        self.user_index = torch.as_tensor(ratings.user_index)
+        self.movie_index = torch.as_tensor(ratings.movie_index)
+        self.rating = torch.as_tensor(ratings.rating)
+        self.movie_metadata_table = movie_metadata_table
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_workers = num_workers
+        self.prefetch_batches = max(prefetch_batches, num_workers)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.rating) // self.batch_size
+        return (len(self.rating) + self.batch_size - 1) // self.batch_size
+
+    def _make_batch(self, batch_indexes):
+        user_index = self.user_index.index_select(0, batch_indexes).long()
+        movie_index = self.movie_index.index_select(0, batch_indexes).long()
+        rating = self.rating.index_select(0, batch_indexes)
+        movie_vectors = self.movie_metadata_table.lookup(movie_index) if self.movie_metadata_table is not None else None
+
+        if self.pin_memory:
+            user_index, movie_index, rating = user_index.pin_memory(), movie_index.pin_memory(), rating.pin_memory()
+            if movie_vectors is not None:
+                movie_vectors = movie_vectors.pin_memory()
+
+        return user_index, movie_index, movie_vectors, rating
+
+    def __iter__(self):
+        """
+        Yields `(user_index, movie_index, movie_vectors, rating)` batches, in order.
+        """
+        if self.shuffle:
+            order = torch.randperm(len(self.rating), generator=self.generator)
+        else:
+            order = torch.arange(len(self.rating))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(self) * self.batch_size, self.batch_size)]
+
+        if self.num_workers == 0:
+            for batch_indexes in batches:
+                yield self._make_batch(batch_indexes)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            # keep a sliding window of `prefetch_batches` batches in flight
+            pending = [executor.submit(self._make_batch, batches[i]) for i in range(min(self.prefetch_batches, len(batches)))]
+            next_to_submit = len(pending)
+            for i in range(len(batches)):
+                batch = pending[i].result()
+                pending[i] = None
+                if next_to_submit < len(batches):
+                    pending.append(executor.submit(self._make_batch, batches[next_to_submit]))
+                    next_to_submit += 1
+                yield batch
@@ -0,0 +1,150 @@
+import torch
+import torch.nn.functional as F
+
+from recommender import load_checkpoint, load_movie_metadata_table, load_ratings
+from evaluate import timed
+from retrieval_index import IVFIndex
+
+"""
+Two-stage recommendation: cheap candidate generation, then re-ranking of only the candidates.
+
+1. candidate generators, each returning its top `budgets[name]` movies:
+   - popularity: log vote count + log popularity prior (from movie_data_vectorized.csv via the metadata columns)
+   - genre: the user's rating-weighted genre affinity, with the popularity prior as a tie-break
+   - similar: inner product with the mean normalized overview vector of the movies the user liked
+     (exact, or through an IVFIndex over the normalized overview vectors)
+2. merge: candidates are deduplicated, movies already in the history are dropped, and at most `budgets["rerank"]`
+   are kept, ordered by their best rank in any generator
+3. re-rank: a batched scorer (`deepfm_reranker` / `lincb_reranker`) scores the candidates and the top k are returned
+
+Every stage is timed.
+"""
+
+DEFAULT_BUDGETS = dict(popularity=100, genre=200, similar=200, rerank=500)
+
+def feature_block(movie_metadata_table, name, chunk_size=65536):
+    """
+    One feature group for every movie as a float32 tensor (dequantized if stored as codes).
+    """
+    columns = slice(*movie_metadata_table.feature_columns[name])
+    num_movies = len(movie_metadata_table.movie_ids)
+    return torch.cat([
+        movie_metadata_table.lookup(torch.arange(start, min(start + chunk_size, num_movies)))[:, columns].float()
+        for start in range(0, num_movies, chunk_size)
+    ])
+
+def merge_candidates(candidates, budget):
+    """
+    Deduplicate the generators' (movie indices, ranks) lists, keeping each movie's best rank,
+    and return at most `budget` movies ordered by it.
+    """
+    movies = torch.cat([movie for movie, _ in candidates])
+    ranks = torch.cat([rank for _, rank in candidates])
+    order = torch.argsort(ranks, stable=True)
+    movies = movies[order]
+    unique, inverse = torch.unique(movies, return_inverse=True)
+    first = torch.full((len(unique),), len(movies)).scatter_reduce(0, inverse, torch.arange(len(movies)), reduce="amin")
+    return movies[first.sort().values][:budget]
+
+def deepfm_reranker(deepfm, movie_metadata_table, user_vector):
+    def score(movie_indices):
+        movie_vectors = movie_metadata_table.lookup(movie_indices).float()
+        return deepfm(movie_vectors, user_vector.expand(len(movie_indices), -1)).squeeze(-1)
+    return score
+
+def lincb_reranker(lincb, movie_metadata_table):
+    def score(movie_indices):
+        return lincb(movie_metadata_table.lookup(movie_indices).float())
+    return score
+
+class RecommendPipeline:
+    def __init__(self, movie_metadata_table, budgets=None, similarity_index: IVFIndex = None):
+        self.movie_metadata_table = movie_metadata_table
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.similarity_index = similarity_index
+
+        metadata = feature_block(movie_metadata_table, "movie_tensor")
+        metadata_columns = movie_metadata_table.metadata_columns
+        column = lambda name: metadata[:, slice(*metadata_columns[name])]
+        # vote_count is stored log1p-transformed already
+        self.popularity_prior = column("vote_count")[:, 0] + column("popularity")[:, 0].clamp(min=0).log1p()
+        # in [0, 1), small enough not to reorder movies with different genre affinity
+        self.tie_break = 0.01 * (self.popularity_prior - self.popularity_prior.min()) / (self.popularity_prior.max() - self.popularity_prior.min() + 1e-6)
+        self.genres = column("genres")
+        self.overview_vectors = F.normalize(feature_block(movie_metadata_table, "overview_vectors"), dim=-1)
+
+    def build_similarity_index(self, **build_kwargs):
+        self.similarity_index = IVFIndex.build(self.overview_vectors, **build_kwargs)
+        return self.similarity_index
+
+    def _top(self, scores, budget):
+        top = scores.topk(min(budget, len(scores))).indices
+        return top, torch.arange(len(top))
+
+    def popularity_candidates(self, history_movies, history_ratings):
+        return self._top(self.popularity_prior, self.budgets["popularity"])
+
+    def genre_candidates(self, history_movies, history_ratings):
+        # movies rated above the user's mean pull their genres up, movies below push them down
+        weights = history_ratings.float() - history_ratings.float().mean()
+        affinity = weights @ self.genres[history_movies]
+        return self._top(self.genres @ affinity + self.tie_break, self.budgets["genre"])
+
+    def similar_candidates(self, history_movies, history_ratings):
+        liked = history_movies[history_ratings >= 7]
+        if len(liked) == 0:
+            liked = history_movies[history_ratings == history_ratings.max()]
+        query = F.normalize(self.overview_vectors[liked].mean(dim=0), dim=-1)
+        budget = self.budgets["similar"]
+        if self.similarity_index is not None:
+            movies = self.similarity_index.search(query.unsqueeze(0), budget)[0][0]
+            movies = movies[movies >= 0]
+            return movies, torch.arange(len(movies))
+        return self._top(self.overview_vectors @ query, budget)
+
+    @torch.no_grad()
+    def recommend(self, history_movies: torch.Tensor, history_ratings: torch.Tensor, reranker, k: int = 20):
+        """
+        :param history_movies: movie indices the user rated
+        :param history_ratings: their ratings (1-10)
+        :param reranker: callable scoring a 1-d tensor of movie indices
+        :returns: top-k movie indices, their re-ranking scores, and per-stage timings in seconds
+        """
+        timings = {}
+        candidates = []
+        generators = [
+            ("popularity", self.popularity_candidates),
+            ("genre", self.genre_candidates),
+            ("similar", self.similar_candidates),
+        ]
+        for name, generator in generators:
+            if self.budgets[name] > 0 and (name == "popularity" or len(history_movies) > 0):
+                with timed(timings, name):
+                    candidates.append(generator(history_movies, history_ratings))
+
+        with timed(timings, "merge"):
+            movies = merge_candidates(candidates, len(self.popularity_prior))
+            movies = movies[~torch.isin(movies, history_movies)][:self.budgets["rerank"]]
+
+        with timed(timings, "rerank"):
+            scores = reranker(movies)
+            top = scores.topk(min(k, len(scores)))
+
+        return movies[top.indices], top.values, timings
+
+def user_history(ratings, user_id):
+    rows = ratings.user_mask([user_id])
+    return torch.from_numpy(ratings.movie_index[rows]).long(), torch.from_numpy(ratings.rating[rows]).long()
+
+if __name__ == '__main__':
+    deepfm, checkpoint = load_checkpoint("deepfm_checkpoint.pt")
+    movie_metadata_table = load_movie_metadata_table()
+    ratings = load_ratings()
+    pipeline = RecommendPipeline(movie_metadata_table)
+
+    for user_row, user_id in list(enumerate(checkpoint["user_ids"]))[:5]:
+        history_movies, history_ratings = user_history(ratings, user_id)
+        reranker = deepfm_reranker(deepfm, movie_metadata_table, checkpoint["user_embeddings"][user_row])
+        movies, scores, timings = pipeline.recommend(history_movies, history_ratings, reranker, k=10)
+        print(f"{user_id}: {[movie_metadata_table.movie_ids[i] for i in movies.tolist()]}")
+        print("  " + " | ".join(f"{name} {seconds * 1000:.2f} ms" for name, seconds in timings.items()))
@@ -1,85 +1,198 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import pandas as pd
+import os
+import time
 
 from movie_metadata_table import MovieMetadataTable
+from ratings_dataset import RatingsDataset, compile_ratings
+from ratings_loader import RatingsBatchLoader
+from sparse_optim import make_sparse_optimizer
 
 import sys
 sys.path.append("../algorithms")
 from deepfm import DeepFM # type: ignore
-
-def train_loop(train_user_ids=None, train_movie_ids=None):
-    ratings = pd.read_csv("../data/ratings_export.csv")
-
-    if train_user_ids is not None:
-        ratings = ratings[ratings['user_id'].isin(train_user_ids)]
-
-    if train_movie_ids is not None:
-        ratings = ratings[ratings['movie_id'].isin(train_movie_ids)]
-
-    # iterate over ratings in random batches
-    indexes = torch.randperm(len(ratings))
-    batch_size = 16
-
-    all_user_ids = ratings['user_id'].unique()
-    all_movie_slugs = ratings['movie_id'].unique()
-
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    user_vector_size = 64
-    user_id_to_index = {user_id: i for i, user_id in enumerate(all_user_ids)}
-    user_embedding_table = nn.Embedding(len(all_user_ids), user_vector_size).to(device)
-    movie_metadata_table = MovieMetadataTable(
+from mlp import MLP, HLGaussLoss # type: ignore
+
+USER_VECTOR_SIZE = 64
+DEEPFM_CONFIG = dict(
+    num_dense_movie_embeddings=8,
+    num_dense_user_embeddings=4,
+    dense_embedding_size=16,
+    mlp_sizes=[16, 16, 1],
+)
+
+def load_ratings(user_ids=None, movie_ids=None):
+    # the CSV is only parsed the first time; afterwards the pre-encoded arrays are loaded directly
+    ratings_dataset_dir = "../data/ratings_dataset"
+    if not os.path.exists(ratings_dataset_dir):
+        compile_ratings(
+            ratings_file="../data/ratings_export.csv",
+            movie_ids_file="../data/movie_ids.json",
+            out_dir=ratings_dataset_dir,
+        )
+    return RatingsDataset(ratings_dataset_dir).select(user_ids=user_ids, movie_ids=movie_ids)
+
+def load_movie_metadata_table():
+    # the feature store is created by running `python movie_metadata_table.py`
+    feature_store_dir = "../data/feature_store"
+    if os.path.exists(feature_store_dir):
+        return MovieMetadataTable.from_feature_store(feature_store_dir)
+    return MovieMetadataTable(
         movie_ids_file="../data/movie_ids.json",
         movie_data_vectorized_file="../data/vectorizing/movie_data_vectorized.csv",
         nlp_vectors_file="../data/vectorizing/nlp_vectors.pt",
     )
+
+def make_optimizers(deepfm, embedding_tables, sparse_optimizer=None, lr=0.001):
+    embedding_parameters = [p for table in embedding_tables for p in table.parameters()]
+    if sparse_optimizer is None:
+        return [torch.optim.Adam([*deepfm.parameters(), *embedding_parameters], lr=lr)]
+    # dense DeepFM weights keep Adam; the embedding tables only update the rows in the batch
+    return [
+        torch.optim.Adam(deepfm.parameters(), lr=lr),
+        make_sparse_optimizer(sparse_optimizer, embedding_parameters, lr=lr),
+    ]
+
+def save_checkpoint(path, deepfm, movie_vector_size, user_embeddings, user_ids, movie_id_embeddings=None):
+    torch.save({
+        "deepfm": deepfm.state_dict(),
+        "deepfm_config": dict(
+            movie_vector_size=movie_vector_size,
+            user_vector_size=user_embeddings.shape[-1],
+            **DEEPFM_CONFIG,
+        ),
+        "user_embeddings": user_embeddings.detach().cpu(),
+        "user_ids": user_ids,
+        "movie_id_embeddings": movie_id_embeddings.detach().cpu() if movie_id_embeddings is not None else None,
+    }, path)
+
+def load_checkpoint(path, device="cpu"):
+    """
+    Load a checkpoint written by `save_checkpoint`. Returns the DeepFM model (in eval mode) and the checkpoint dict.
+    """
+    checkpoint = torch.load(path, map_location=device)
+    config = dict(checkpoint["deepfm_config"])
+    deepfm = DeepFM(config.pop("movie_vector_size"), config.pop("user_vector_size"), **config).to(device)
+    deepfm.load_state_dict(checkpoint["deepfm"])
+    deepfm.eval()
+    return deepfm, checkpoint
+
+def load_mlp_checkpoint(path="mlp_checkpoint.pt", device="cpu"):
+    """
+    Load a checkpoint written by `train_mlp.train_mlp_loop`.
+    Returns the MLP (in eval mode), its HLGaussLoss (whose `predict` turns logits into ratings) and the checkpoint dict.
+    """
+    checkpoint = torch.load(path, map_location=device)
+    mlp = MLP(**checkpoint["mlp_config"]).to(device)
+    mlp.load_state_dict(checkpoint["mlp"])
+    mlp.eval()
+    loss_fn = HLGaussLoss(**checkpoint["hl_gauss_config"], discrete_rewards=checkpoint.get("rating_values")).to(device)
+    return mlp, loss_fn, checkpoint
+
+def train_loop(
+    train_user_ids=None,
+    train_movie_ids=None,
+    batch_size=16,
+    num_workers=2,
+    pin_memory=True,
+    log_every=100,
+    sparse_optimizer=None,
+    movie_id_embedding_size=0,
+    checkpoint_path="deepfm_checkpoint.pt",
+    precision="fp32",
+):
+    """
+    :params:
+     - `sparse_optimizer`: None trains the embedding tables with the same dense Adam as DeepFM.
+        "sparse_adam" or "rowwise_adagrad" makes the embeddings produce sparse gradients and updates them with that
+        optimizer, so only the rows in the batch are touched and the step cost does not grow with the number of users.
+     - `movie_id_embedding_size`: if > 0, a learned per-movie embedding is appended to the movie features
+     - `precision`: "fp32", or "bf16" to run the forward pass under bfloat16 autocast. Weights and optimizer
+        state stay float32 either way. (The stored movie features have their own dtype, set when compiling the feature store.)
+    """
+    ratings = load_ratings(train_user_ids, train_movie_ids)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    user_vector_size = USER_VECTOR_SIZE
+    sparse = sparse_optimizer is not None
+    user_embedding_table = nn.Embedding(len(ratings.user_ids), user_vector_size, sparse=sparse).to(device)
+    embedding_tables = [user_embedding_table]
+    movie_id_embedding_table = None
+    if movie_id_embedding_size > 0:
+        movie_id_embedding_table = nn.Embedding(len(ratings.movie_ids), movie_id_embedding_size, sparse=sparse).to(device)
+        embedding_tables.append(movie_id_embedding_table)
+    movie_metadata_table = load_movie_metadata_table()
+    # movie indices in the ratings dataset are rows of the movie table
+    assert len(movie_metadata_table.movie_ids) == len(ratings.movie_ids)
     deepfm = DeepFM(
-        movie_metadata_table.movie_vector_size,
+        movie_metadata_table.movie_vector_size + movie_id_embedding_size,
         user_vector_size,
-        num_dense_movie_embeddings=8,
-        num_dense_user_embeddings=4,
-        dense_embedding_size=16,
-        mlp_sizes=[16, 16, 1],
+        **DEEPFM_CONFIG,
     ).to(device)
 
-    # note: if we want to get a massive speedup,
-    # we can probably use a sparse optimization scheme somehow
-    optim = torch.optim.Adam([
-        *deepfm.parameters(),
-        *user_embedding_table.parameters()
-    ], lr=0.001)
+    optims = make_optimizers(deepfm, embedding_tables, sparse_optimizer)
 
     # determine how to give a reward
     # we will just give a reward if the user rated the movie >= 7/10
 
     loss_type = "mse"
 
-    for batch_start in range(0, len(indexes), batch_size):
-        batch = ratings.iloc[indexes[batch_start:batch_start + batch_size]]
-
-        movie_slugs = [str(x) for x in batch['movie_id'].values]
-        train_user_ids = batch['user_id'].values
-        ratings = batch['rating_val'].values
-
-        user_indices = torch.tensor([user_id_to_index[user_id] for user_id in train_user_ids], device=device)
-        user_vectors = user_embedding_table(user_indices)
-        movie_vectors = movie_metadata_table(movie_slugs).to(device)
-
-        predictions = deepfm(movie_vectors.float(), user_vectors.float()).squeeze(-1)
-        rewards = torch.tensor(ratings >= 7, device=device)
-
-        if loss_type == 'mse':
-            # resembles learning q function
-            loss = F.mse_loss(predictions, rewards)
-        elif loss_type == 'binary_crossentropy':
-            # loosely resembles policy gradient
-            loss = F.binary_cross_entropy_with_logits(predictions, rewards.float())
+    # iterate over ratings in random batches, assembled ahead of time by background workers
+    loader = RatingsBatchLoader(
+        ratings,
+        movie_metadata_table,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+    )
 
-        optim.zero_grad()
+    start_time = time.perf_counter()
+    num_samples = 0
+    for step, (user_index, movie_index, movie_vectors, rating) in enumerate(loader):
+        with torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=precision == "bf16"):
+            user_vectors = user_embedding_table(user_index.to(device, non_blocking=True))
+            # 16-bit stored features are only upcast per batch; autocast handles the bf16 path
+            movie_vectors = movie_vectors.to(device, non_blocking=True).float()
+            if movie_id_embedding_table is not None:
+                movie_id_vectors = movie_id_embedding_table(movie_index.to(device, non_blocking=True))
+                movie_vectors = torch.cat([movie_vectors, movie_id_vectors], dim=-1)
+
+            predictions = deepfm(movie_vectors, user_vectors).squeeze(-1).float()
+            rewards = (rating >= 7).float().to(device, non_blocking=True)
+
+            if loss_type == 'mse':
+                # resembles learning q function
+                loss = F.mse_loss(predictions, rewards)
+            elif loss_type == 'binary_crossentropy':
+                # loosely resembles policy gradient
+                loss = F.binary_cross_entropy_with_logits(predictions, rewards.float())
+
+        for optim in optims:
+            optim.zero_grad()
         loss.backward()
-        optim.step()
-
-        print(loss.item())
-
-train_loop()
+        for optim in optims:
+            optim.step()
+
+        num_samples += len(rating)
+        if step % log_every == 0:
+            elapsed = time.perf_counter() - start_time
+            print(f"step {step}/{len(loader)} | loss {loss.item():.4f} | {num_samples / elapsed:,.0f} samples/sec")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"trained on {num_samples} samples in {elapsed:.1f}s ({num_samples / elapsed:,.0f} samples/sec)")
+
+    if checkpoint_path is not None:
+        save_checkpoint(
+            checkpoint_path,
+            deepfm,
+            movie_metadata_table.movie_vector_size + movie_id_embedding_size,
+            user_embedding_table.weight,
+            ratings.user_ids,
+            movie_id_embedding_table.weight if movie_id_embedding_table is not None else None,
+        )
+
+    return deepfm, user_embedding_table
+
+if __name__ == '__main__':
+    train_loop()
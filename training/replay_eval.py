@@ -0,0 +1,211 @@
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from recommender import load_movie_metadata_table, load_ratings
+from movie_metadata_table import MovieMetadataTable
+
+import sys
+sys.path.append("../algorithms")
+from lincb import LinCB, LinCBBank # type: ignore
+from mlp import MLP # type: ignore
+
+"""
+Offline evaluation of bandit policies by replaying the ratings log.
+
+Every logged rating (user, movie, reward = rating >= 7) becomes one bandit round: the logged movie is hidden at a random
+position among `num_candidates - 1` uniformly sampled movies, as if a uniform logging policy had shown it, so its
+propensity is 1 / num_candidates. The policy picks the best-scoring candidate and
+ - replay: the average reward over the rounds where the pick is the logged movie
+ - IPS: mean(1[pick == logged] * reward * num_candidates)
+ - doubly robust: mean(reward_model(pick) + 1[pick == logged] * num_candidates * (reward - reward_model(logged))),
+   with a smoothed per-movie mean reward as the reward model
+Rounds are processed `chunk_size` at a time: the candidates' features are gathered, scored and the policy is updated
+once per chunk (on the matched rounds by default, as in the replay method, or on every logged rating).
+
+Events are replayed in log order (the scraped export has no diary dates). With several workers, users are sharded
+(user_index % num_workers) and every worker runs its own copy of the policy on its shard.
+"""
+
+class RandomPolicy:
+    def __init__(self, vector_dims):
+        pass
+
+    def scores(self, user, context):
+        return torch.rand(context.shape[:-1])
+
+    def update(self, user, context, reward):
+        pass
+
+class LinCBPolicy:
+    def __init__(self, vector_dims, use_thompson_sampling=False):
+        self.lincb = LinCB(vector_dims, update_method="woodbury")
+        self.use_thompson_sampling = use_thompson_sampling
+
+    def scores(self, user, context):
+        return self.lincb(context.flatten(0, 1), self.use_thompson_sampling).view(context.shape[:-1])
+
+    def update(self, user, context, reward):
+        self.lincb.update(context, reward)
+
+class LinCBBankPolicy:
+    def __init__(self, vector_dims, max_resident=128):
+        self.bank = LinCBBank(vector_dims, max_resident=max_resident)
+
+    def scores(self, user, context):
+        return self.bank(user.tolist(), context)
+
+    def update(self, user, context, reward):
+        self.bank.update(user.tolist(), context, reward)
+
+    def close(self):
+        self.bank.close()
+
+class MLPPolicy:
+    def __init__(self, vector_dims, hidden_dims=64, lr=0.001):
+        self.mlp = MLP(vector_dims, hidden_dims, 1)
+        self.optim = torch.optim.Adam(self.mlp.parameters(), lr=lr)
+
+    def scores(self, user, context):
+        with torch.no_grad():
+            return self.mlp(context)[..., 0]
+
+    def update(self, user, context, reward):
+        loss = F.mse_loss(self.mlp(context)[..., 0], reward)
+        self.optim.zero_grad()
+        loss.backward()
+        self.optim.step()
+
+POLICIES = {
+    "random": RandomPolicy,
+    "lincb": LinCBPolicy,
+    "lincb_thompson": lambda vector_dims: LinCBPolicy(vector_dims, use_thompson_sampling=True),
+    "lincb_bank": LinCBBankPolicy,
+    "mlp": MLPPolicy,
+}
+
+def movie_reward_model(ratings, num_movies, prior_weight=10.0):
+    """
+    Per-movie mean reward, shrunk towards the global mean with `prior_weight` pseudo-ratings.
+    """
+    movie = torch.from_numpy(ratings.movie_index).long()
+    reward = torch.from_numpy(ratings.rating >= 7).float()
+    global_mean = reward.mean()
+    sums = torch.bincount(movie, weights=reward, minlength=num_movies)
+    counts = torch.bincount(movie, minlength=num_movies)
+    return (sums + prior_weight * global_mean) / (counts + prior_weight)
+
+def replay(policy, ratings, movie_metadata_table, reward_model, num_candidates=20, chunk_size=1024, update_on="match", max_events=None, seed=0):
+    """
+    Replay `ratings` through `policy`. Returns the estimator sums, the event count and the elapsed time.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_movies = len(movie_metadata_table.movie_ids)
+    num_events = len(ratings) if max_events is None else min(len(ratings), max_events)
+    totals = {"events": 0, "matches": 0, "replay_reward": 0.0, "ips": 0.0, "dr": 0.0}
+
+    start_time = time.perf_counter()
+    for start in range(0, num_events, chunk_size):
+        end = min(start + chunk_size, num_events)
+        user = torch.from_numpy(ratings.user_index[start:end]).long()
+        logged = torch.from_numpy(ratings.movie_index[start:end]).long()
+        reward = torch.from_numpy(ratings.rating[start:end] >= 7).float()
+        batch_size = len(user)
+
+        # [batch, num_candidates] with the logged movie at a random position
+        candidates = torch.randint(0, num_movies, (batch_size, num_candidates), generator=generator)
+        position = torch.randint(0, num_candidates, (batch_size,), generator=generator)
+        candidates[torch.arange(batch_size), position] = logged
+        context = movie_metadata_table.lookup(candidates).float()
+
+        pick = policy.scores(user, context).argmax(dim=-1)
+        match = pick == position
+        predicted = reward_model[candidates]
+        totals["events"] += batch_size
+        totals["matches"] += int(match.sum())
+        totals["replay_reward"] += float(reward[match].sum())
+        totals["ips"] += float((match * reward).sum() * num_candidates)
+        correction = match * num_candidates * (reward - predicted.gather(1, position.unsqueeze(-1)).squeeze(-1))
+        totals["dr"] += float((predicted.gather(1, pick.unsqueeze(-1)).squeeze(-1) + correction).sum())
+
+        rows = match if update_on == "match" else torch.ones_like(match)
+        if rows.any():
+            policy.update(user[rows], context[rows, position[rows]], reward[rows])
+    totals["elapsed"] = time.perf_counter() - start_time
+    return totals
+
+def replay_worker(rank, world_size, policy_name, movie_table_source, kwargs, results):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(rank)
+    if type(movie_table_source) == str:
+        movie_metadata_table = MovieMetadataTable.from_feature_store(movie_table_source)
+    else:
+        movie_metadata_table = movie_table_source
+
+    ratings = load_ratings()
+    reward_model = movie_reward_model(ratings, len(movie_metadata_table.movie_ids))
+    shard = (ratings.user_index % world_size) == rank
+    ratings.user_index = ratings.user_index[shard]
+    ratings.movie_index = ratings.movie_index[shard]
+    ratings.rating = ratings.rating[shard]
+
+    if kwargs.get("max_events") is not None:
+        # `max_events` is the total over all workers; the first workers take the remainder
+        kwargs = dict(kwargs, max_events=kwargs["max_events"] // world_size + (rank < kwargs["max_events"] % world_size))
+
+    policy = POLICIES[policy_name](movie_metadata_table.movie_vector_size)
+    try:
+        results[rank] = replay(policy, ratings, movie_metadata_table, reward_model, seed=rank, **kwargs)
+    finally:
+        # policies holding on-disk state (the LinCB bank's spill files) release it here
+        if hasattr(policy, "close"):
+            policy.close()
+
+def evaluate_policy(policy_name, num_workers=1, **kwargs):
+    """
+    Replay the log through `policy_name` (a key of POLICIES) on `num_workers` user shards.
+    A `max_events` limit is split across the shards, so it bounds the total number of replayed events.
+    Returns the replay / IPS / DR estimates and the throughput.
+    """
+    feature_store_dir = "../data/feature_store"
+    if os.path.exists(feature_store_dir):
+        movie_table_source = feature_store_dir
+    else:
+        movie_table_source = load_movie_metadata_table()
+        movie_table_source.movie_matrix.share_memory_()
+
+    start_time = time.perf_counter()
+    if num_workers == 1:
+        results = {}
+        replay_worker(0, 1, policy_name, movie_table_source, kwargs, results)
+    else:
+        with mp.Manager() as manager:
+            shared_results = manager.dict()
+            mp.spawn(replay_worker, args=(num_workers, policy_name, movie_table_source, kwargs, shared_results), nprocs=num_workers)
+            results = dict(shared_results)
+    elapsed = time.perf_counter() - start_time
+
+    totals = {key: sum(shard[key] for shard in results.values()) for key in ["events", "matches", "replay_reward", "ips", "dr"]}
+    events = totals["events"]
+    return {
+        "events": events,
+        "matches": totals["matches"],
+        "replay": totals["replay_reward"] / max(totals["matches"], 1),
+        "ips": totals["ips"] / events,
+        "dr": totals["dr"] / events,
+        # replay only, and including worker startup
+        "events_per_sec": events / max(shard["elapsed"] for shard in results.values()),
+        "wall_events_per_sec": events / elapsed,
+    }
+
+if __name__ == '__main__':
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for policy_name in ["random", "mlp", "lincb", "lincb_thompson", "lincb_bank"]:
+        result = evaluate_policy(policy_name, num_workers=num_workers)
+        print(
+            f"{policy_name:>15}: replay {result['replay']:.4f} ({result['matches']:,} matches) | IPS {result['ips']:.4f} | DR {result['dr']:.4f} | "
+            f"{result['events_per_sec']:,.0f} events/sec ({result['wall_events_per_sec']:,.0f} wall)"
+        )
@@ -0,0 +1,167 @@
+import json
+import math
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from recommender import load_checkpoint, load_movie_metadata_table
+
+"""
+Approximate top-K retrieval of movies by inner product (IVF index).
+
+Movie embeddings are the dot-product part of DeepFM (`DeepFM.retrieval_embeddings`), so a user's
+`DeepFM.retrieval_queries` vector ranks movies by the FM term without running the model.
+
+Maximum inner product search is turned into nearest-neighbour search by appending sqrt(max_norm^2 - |x|^2)
+to every movie embedding and 0 to the query: |q - x|^2 = |q|^2 + max_norm^2 - 2 <q, x>.
+k-means on the augmented vectors partitions the movies into `num_lists` inverted lists, stored contiguously.
+A query scores the centroids, takes the `num_probe` nearest lists and does an exact dot product over only those movies.
+
+The index is persisted as .npy files plus a manifest and memory-mapped on load.
+"""
+
+RETRIEVAL_INDEX_VERSION = 1
+
+def kmeans(x: torch.Tensor, num_clusters: int, iterations: int = 20, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_clusters]].clone()
+    for _ in range(iterations):
+        assignments = torch.cdist(x, centroids).argmin(dim=-1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=len(centroids))
+        # empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(-1)
+    return centroids
+
+def nearest_centroid(x: torch.Tensor, centroids: torch.Tensor, chunk_size: int = 65536):
+    return torch.cat([torch.cdist(x[start:start + chunk_size], centroids).argmin(dim=-1) for start in range(0, len(x), chunk_size)])
+
+class IVFIndex:
+    def __init__(self, centroids: torch.Tensor, offsets: torch.Tensor, item_ids: torch.Tensor, vectors: torch.Tensor):
+        # [num_lists, dims + 1] augmented centroids, [num_lists + 1] list boundaries,
+        # [num_items] original item index and [num_items, dims] vectors, both ordered by list
+        self.centroids = centroids
+        self.offsets = offsets
+        self.item_ids = item_ids
+        self.vectors = vectors
+        self.list_sizes = offsets[1:] - offsets[:-1]
+        self.centroid_norms = (centroids ** 2).sum(dim=-1)
+
+    @classmethod
+    def build(cls, vectors: torch.Tensor, num_lists: int = None, training_samples: int = 65536, iterations: int = 20, seed: int = 0):
+        # default: ~4 sqrt(num_items) lists (about 2000 for the full catalogue)
+        num_lists = num_lists or 4 * math.isqrt(len(vectors))
+        vectors = vectors.float()
+        norms = (vectors ** 2).sum(dim=-1)
+        augmented = torch.cat([vectors, (norms.max() - norms).clamp(min=0).sqrt().unsqueeze(-1)], dim=-1)
+
+        generator = torch.Generator().manual_seed(seed)
+        sample = augmented[torch.randperm(len(augmented), generator=generator)[:training_samples]]
+        centroids = kmeans(sample, min(num_lists, len(sample)), iterations, seed)
+
+        assignments = nearest_centroid(augmented, centroids)
+        order = torch.argsort(assignments, stable=True)
+        offsets = torch.zeros(len(centroids) + 1, dtype=torch.int64)
+        offsets[1:] = torch.cumsum(torch.bincount(assignments, minlength=len(centroids)), 0)
+        return cls(centroids, offsets, order, vectors[order].contiguous())
+
+    def search(self, queries: torch.Tensor, k: int, num_probe: int = 64):
+        """
+        :param queries: [num_queries, dims]
+        :returns: ([num_queries, k] item indices, [num_queries, k] scores), best first. Rows with fewer than
+        k candidates in the probed lists are padded with index -1 and score -inf.
+        """
+        queries = queries.float()
+        num_probe = min(num_probe, len(self.centroids))
+        # nearest augmented centroids to the augmented query [q, 0]: maximize 2 <q, c> - |c|^2
+        centroid_scores = 2 * queries @ self.centroids[:, :-1].T - self.centroid_norms
+        probe = centroid_scores.topk(num_probe, dim=-1).indices
+
+        # flatten the probed lists of every query into one padded [num_queries, max candidates] row index
+        lengths = self.list_sizes[probe]
+        ends = lengths.cumsum(dim=-1)
+        totals = ends[:, -1]
+        position = torch.arange(int(totals.max())).repeat(len(queries), 1)
+        slot = torch.searchsorted(ends, position, right=True).clamp(max=num_probe - 1)
+        rows = self.offsets[probe].gather(1, slot) + position - (ends - lengths).gather(1, slot)
+        valid = position < totals.unsqueeze(-1)
+        rows = torch.where(valid, rows, 0)
+
+        scores = torch.bmm(self.vectors[rows], queries.unsqueeze(-1)).squeeze(-1)
+        scores = scores.masked_fill(~valid, float("-inf"))
+        top = scores.topk(min(k, scores.shape[1]), dim=-1)
+        item_ids = self.item_ids[rows.gather(1, top.indices)]
+        item_ids = item_ids.masked_fill(top.values == float("-inf"), -1)
+        if top.values.shape[1] < k:
+            padding = k - top.values.shape[1]
+            item_ids = torch.nn.functional.pad(item_ids, (0, padding), value=-1)
+            return item_ids, torch.nn.functional.pad(top.values, (0, padding), value=float("-inf"))
+        return item_ids, top.values
+
+    def exact_search(self, queries: torch.Tensor, k: int):
+        top = (queries.float() @ self.vectors.T).topk(k, dim=-1)
+        return self.item_ids[top.indices], top.values
+
+    def save(self, out_dir):
+        tmp_dir = out_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        arrays = {"centroids": self.centroids, "offsets": self.offsets, "item_ids": self.item_ids, "vectors": self.vectors}
+        for name, tensor in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), tensor.numpy())
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump({"version": RETRIEVAL_INDEX_VERSION, "num_items": len(self.item_ids), "num_lists": len(self.centroids)}, f, indent=2)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.rename(tmp_dir, out_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != RETRIEVAL_INDEX_VERSION:
+            raise ValueError(f"Retrieval index at {index_dir} has version {manifest['version']}, expected {RETRIEVAL_INDEX_VERSION}. Rebuild it with `python retrieval_index.py`.")
+        arrays = {
+            name: torch.from_numpy(np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="c"))
+            for name in ["centroids", "offsets", "item_ids", "vectors"]
+        }
+        return cls(**arrays)
+
+def recall_at_k(index: IVFIndex, queries: torch.Tensor, k: int, num_probe: int = 64):
+    """
+    Fraction of the exact top-k items that the approximate search returns, averaged over the queries.
+    """
+    approximate, _ = index.search(queries, k, num_probe)
+    exact, _ = index.exact_search(queries, k)
+    hits = (approximate.unsqueeze(-1) == exact.unsqueeze(-2)).any(dim=-1).sum(dim=-1)
+    return (hits.float() / k).mean().item()
+
+@torch.no_grad()
+def build_deepfm_index(deepfm, movie_metadata_table, num_lists=None, chunk_size=65536):
+    num_movies = len(movie_metadata_table.movie_ids)
+    embeddings = torch.cat([
+        deepfm.retrieval_embeddings(movie_metadata_table.lookup(torch.arange(start, min(start + chunk_size, num_movies))).float())
+        for start in range(0, num_movies, chunk_size)
+    ])
+    return IVFIndex.build(embeddings, num_lists=num_lists)
+
+if __name__ == '__main__':
+    deepfm, checkpoint = load_checkpoint("deepfm_checkpoint.pt")
+    movie_metadata_table = load_movie_metadata_table()
+    start = time.perf_counter()
+    build_deepfm_index(deepfm, movie_metadata_table).save("../data/retrieval_index")
+    print(f"built index in {time.perf_counter() - start:.1f}s")
+
+    index = IVFIndex.load("../data/retrieval_index")
+    with torch.no_grad():
+        queries = deepfm.retrieval_queries(checkpoint["user_embeddings"][:1000])
+    for num_probe in [16, 64, 128]:
+        index.search(queries[:1], 100, num_probe)
+        start = time.perf_counter()
+        for query in queries[:100]:
+            index.search(query.unsqueeze(0), 100, num_probe)
+        ms = (time.perf_counter() - start) / min(100, len(queries)) * 1000
+        print(f"num_probe {num_probe:>4}: {ms:.2f} ms/query | recall@100 {recall_at_k(index, queries, 100, num_probe):.3f}")
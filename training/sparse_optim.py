@@ -0,0 +1,53 @@
+import torch
+
+"""
+Optimizers for embedding tables with sparse gradients (nn.Embedding(..., sparse=True)).
+
+Both only touch the rows that appear in the batch, so the per-step cost depends on the batch size
+rather than on the number of users.
+"""
+
+class RowWiseAdagrad(torch.optim.Optimizer):
+    """
+    Adagrad with a single accumulator per embedding row (the mean squared gradient of the row)
+    instead of one per element, which cuts the optimizer state from [rows, dims] to [rows].
+    """
+    def __init__(self, params, lr=0.01, eps=1e-10, initial_accumulator_value=0.0):
+        super().__init__(params, dict(lr=lr, eps=eps, initial_accumulator_value=initial_accumulator_value))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                assert p.grad.is_sparse, "RowWiseAdagrad expects sparse gradients; use nn.Embedding(..., sparse=True)"
+                state = self.state[p]
+                if len(state) == 0:
+                    state['sum'] = torch.full((p.shape[0],), group['initial_accumulator_value'], dtype=p.dtype, device=p.device)
+
+                # duplicate rows in the batch are summed by coalesce()
+                grad = p.grad.coalesce()
+                rows = grad.indices()[0]
+                values = grad.values()
+
+                row_sum = state['sum'].index_add_(0, rows, values.pow(2).mean(dim=-1))[rows]
+                p.index_add_(0, rows, values * (-group['lr'] / (row_sum.sqrt() + group['eps'])).unsqueeze(-1))
+
+        return loss
+
+def make_sparse_optimizer(name, params, lr):
+    """
+    :params:
+     - `name`: "sparse_adam" or "rowwise_adagrad"
+    """
+    if name == "sparse_adam":
+        return torch.optim.SparseAdam(params, lr=lr)
+    elif name == "rowwise_adagrad":
+        return RowWiseAdagrad(params, lr=lr)
+    raise ValueError(f"Unknown sparse optimizer: {name}")
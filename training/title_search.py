@@ -0,0 +1,118 @@
+import re
+import unicodedata
+
+import numpy as np
+
+from feature_store import encode_strings, decode_strings
+
+"""
+Title search index for the Streamlit sidebar.
+
+Titles are normalized (NFKD, combining marks dropped, casefolded, punctuation collapsed to single spaces), so
+"amelie" finds "Amélie" and "spider man" finds "Spider-Man". Movies are numbered by rank (most votes first, then
+popularity) and every posting list holds ranks in ascending order, so the first matches found are the best ranked:
+ - trigram lists: every movie whose normalized title contains the trigram. A query of 3+ characters starts from its
+   rarest trigram, filters it chunk by chunk with binary searches into the other trigrams' lists and confirms the
+   substring on the title itself, stopping after `limit` matches
+ - prefix lists ("^a", "^ab"): every movie with a title word starting with 1-2 characters, for queries too short
+   to have a trigram
+All arrays are flat (keys + int64 offsets into one int32 postings array), so the index is stored in the catalogue's
+feature store and memory-mapped by every session.
+"""
+
+PREFIX_MARKER = "^"
+MAX_PREFIX_LENGTH = 2
+
+def normalize_title(text):
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[\W_]+", " ", text.casefold()).split())
+
+def title_keys(normalized):
+    keys = {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+    for word in normalized.split():
+        for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+            keys.add(PREFIX_MARKER + word[:length])
+    return keys
+
+class TitleSearchIndex:
+    def __init__(self, keys, offsets, postings, rank_rows, normalized_offsets, normalized_utf8):
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+        # rank -> catalogue row
+        self.rank_rows = rank_rows
+        self.normalized = (normalized_offsets, normalized_utf8)
+        self.key_index = {key: i for i, key in enumerate(keys.tolist())}
+
+    @classmethod
+    def build(cls, titles, vote_count, popularity):
+        """
+        `titles` (strings, NaN for missing) and the ranking columns, one entry per catalogue row.
+        """
+        vote_count = np.nan_to_num(np.asarray(vote_count, dtype=np.float64))
+        popularity = np.nan_to_num(np.asarray(popularity, dtype=np.float64))
+        rank_rows = np.lexsort((-popularity, -vote_count)).astype(np.int32)
+
+        normalized = [normalize_title(titles[row]) if type(titles[row]) is str else "" for row in rank_rows]
+        key_ids = {}
+        posting_keys, posting_ranks = [], []
+        for rank, title in enumerate(normalized):
+            for key in title_keys(title):
+                posting_keys.append(key_ids.setdefault(key, len(key_ids)))
+                posting_ranks.append(rank)
+        posting_keys = np.array(posting_keys, dtype=np.int64)
+        posting_ranks = np.array(posting_ranks, dtype=np.int32)
+
+        order = np.lexsort((posting_ranks, posting_keys))
+        offsets = np.zeros(len(key_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_keys, minlength=len(key_ids)), out=offsets[1:])
+        keys = np.array(list(key_ids), dtype="<U3")
+        return cls(keys, offsets, posting_ranks[order], rank_rows, *encode_strings(normalized))
+
+    def arrays(self):
+        return {
+            "keys": self.keys,
+            "offsets": self.offsets,
+            "postings": self.postings,
+            "rank_rows": self.rank_rows,
+            "normalized.offsets": self.normalized[0],
+            "normalized.utf8": self.normalized[1],
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(arrays[name] for name in ["keys", "offsets", "postings", "rank_rows", "normalized.offsets", "normalized.utf8"]))
+
+    def posting_list(self, key):
+        key_id = self.key_index.get(key)
+        if key_id is None:
+            return self.postings[:0]
+        return self.postings[self.offsets[key_id]:self.offsets[key_id + 1]]
+
+    def search(self, query, limit=50):
+        """
+        Catalogue rows of the best ranked titles containing `query`, at most `limit` of them.
+        """
+        query = normalize_title(query)
+        if not query:
+            return np.zeros(0, dtype=np.int64)
+        if len(query) <= MAX_PREFIX_LENGTH:
+            return self.rank_rows[self.posting_list(PREFIX_MARKER + query)[:limit]].astype(np.int64)
+
+        lists = sorted((self.posting_list(key) for key in {query[i:i + 3] for i in range(len(query) - 2)}), key=len)
+        matches = []
+        # ranks ascend in every list, so candidates are filtered a chunk at a time until `limit` matches are found
+        chunk_size = max(4 * limit, 256)
+        for start in range(0, len(lists[0]), chunk_size):
+            candidates = lists[0][start:start + chunk_size]
+            for other in lists[1:]:
+                positions = np.searchsorted(other, candidates).clip(max=len(other) - 1)
+                candidates = candidates[other[positions] == candidates]
+            # trigrams only narrow the candidates down; the substring check makes the match exact
+            for rank in candidates.tolist():
+                if query in decode_strings(*self.normalized, [rank])[0]:
+                    matches.append(rank)
+                    if len(matches) == limit:
+                        return self.rank_rows[matches].astype(np.int64)
+        return self.rank_rows[matches].astype(np.int64)
@@ -0,0 +1,94 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from recommender import USER_VECTOR_SIZE, load_movie_metadata_table, load_ratings, make_optimizers
+from ratings_loader import RatingsBatchLoader
+
+import sys
+sys.path.append("../algorithms")
+from mlp import MLP, HLGaussLoss # type: ignore
+
+"""
+Trains the MLP Q-function as a distributional value head over the rating (1-10) with the HL-Gauss loss.
+Input: the movie vector concatenated with a learned user embedding. Output: `m` logits over the rating bins;
+the predicted rating is the expected value of the bin distribution.
+"""
+
+MLP_HIDDEN_DIMS = 256
+HL_GAUSS_CONFIG = dict(v_min=0.5, v_max=10.5, m=40, hl_gaussian_sigma_over_binsize=0.75)
+# Letterboxd ratings are whole numbers of half-stars, stored as 1-10
+RATING_VALUES = list(range(1, 11))
+
+def train_mlp_loop(
+    train_user_ids=None,
+    train_movie_ids=None,
+    batch_size=1024,
+    num_workers=2,
+    pin_memory=True,
+    log_every=100,
+    sparse_optimizer="sparse_adam",
+    checkpoint_path="mlp_checkpoint.pt",
+):
+    ratings = load_ratings(train_user_ids, train_movie_ids)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    movie_metadata_table = load_movie_metadata_table()
+    assert len(movie_metadata_table.movie_ids) == len(ratings.movie_ids)
+
+    user_embedding_table = nn.Embedding(len(ratings.user_ids), USER_VECTOR_SIZE, sparse=sparse_optimizer is not None).to(device)
+    mlp = MLP(movie_metadata_table.movie_vector_size + USER_VECTOR_SIZE, MLP_HIDDEN_DIMS, HL_GAUSS_CONFIG["m"]).to(device)
+    loss_fn = HLGaussLoss(**HL_GAUSS_CONFIG, discrete_rewards=RATING_VALUES).to(device)
+    optims = make_optimizers(mlp, [user_embedding_table], sparse_optimizer)
+
+    loader = RatingsBatchLoader(
+        ratings,
+        movie_metadata_table,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+    )
+
+    start_time = time.perf_counter()
+    num_samples = 0
+    for step, (user_index, _, movie_vectors, rating) in enumerate(loader):
+        user_vectors = user_embedding_table(user_index.to(device, non_blocking=True))
+        movie_vectors = movie_vectors.to(device, non_blocking=True).float()
+        rating = rating.to(device, non_blocking=True)
+        logits = mlp(torch.cat([movie_vectors, user_vectors], dim=-1))
+        loss = loss_fn(logits, rating)
+
+        for optim in optims:
+            optim.zero_grad()
+        loss.backward()
+        for optim in optims:
+            optim.step()
+
+        num_samples += len(rating)
+        if step % log_every == 0:
+            elapsed = time.perf_counter() - start_time
+            with torch.no_grad():
+                mae = (loss_fn.predict(logits) - rating.float()).abs().mean()
+            print(f"step {step}/{len(loader)} | loss {loss.item():.4f} | rating MAE {mae.item():.3f} | {num_samples / elapsed:,.0f} samples/sec")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"trained on {num_samples} samples in {elapsed:.1f}s ({num_samples / elapsed:,.0f} samples/sec)")
+
+    if checkpoint_path is not None:
+        torch.save({
+            "mlp": mlp.state_dict(),
+            "mlp_config": dict(
+                input_dims=movie_metadata_table.movie_vector_size + USER_VECTOR_SIZE,
+                hidden_dims=MLP_HIDDEN_DIMS,
+                output_dims=HL_GAUSS_CONFIG["m"],
+            ),
+            "hl_gauss_config": HL_GAUSS_CONFIG,
+            "rating_values": RATING_VALUES,
+            "user_embeddings": user_embedding_table.weight.detach().cpu(),
+            "user_ids": ratings.user_ids,
+        }, checkpoint_path)
+
+    return mlp, user_embedding_table, loss_fn
+
+if __name__ == '__main__':
+    train_mlp_loop()
@@ -1,9 +1,177 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
 import torch
-import torch.nn as nn
-
-# stores vectors in memory.
-# could likely be updated to lazily allocate embedding table space.
-class UserVectorTable(nn.Module):
-    def __init__(self, capacity: int, num_dimensions: int):
-        self.embedding = nn.Parameter(torch.randn(capacity, num_dimensions))
-        pass
+
+# stores user vectors in fixed-size chunks that are allocated the first time a user in them is seen.
+# recently used chunks are kept in RAM; the least recently used ones are spilled to .npy files on disk.
+# a spilled chunk is read back into RAM with np.load when a user in it is seen again, and written back to
+# its spill file on eviction if it changed since it was last written.
+class UserVectorTable:
+    def __init__(self, num_dimensions: int, chunk_size: int = 65536, max_resident_chunks: int = 64, spill_dir: str = None, init_std: float = 1.0):
+        """
+        :params:
+         - `chunk_size`: rows per chunk. The table grows one chunk at a time, without copying existing rows.
+         - `max_resident_chunks`: how many chunks to keep in RAM (memory: chunk_size * num_dimensions * 4 bytes each)
+         - `spill_dir`: where cold chunks are written. Defaults to a temporary directory, removed by `close`.
+         - `init_std`: new rows are initialized from N(0, init_std^2)
+        """
+        self.num_dimensions = num_dimensions
+        self.chunk_size = chunk_size
+        self.max_resident_chunks = max_resident_chunks
+        # a spill directory the table created itself is deleted with the table; a caller's is left alone
+        self.owns_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir if spill_dir is not None else tempfile.mkdtemp(prefix="user_vectors_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.init_std = init_std
+
+        self.usernames = []
+        self.username_to_row = {}
+        # per chunk: a tensor when resident, None when spilled
+        self.chunks = []
+        # per chunk: the .npy file holding its latest spilled copy, if any
+        self.chunk_files = []
+        # resident chunk ids, least recently used first
+        self.resident = OrderedDict()
+        # resident chunks that changed since they were last written to disk
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def rows(self, usernames, create: bool = True):
+        """
+        Map usernames to row indices, allocating rows for usernames seen for the first time.
+        With `create=False`, unknown usernames map to -1.
+        """
+        rows = []
+        for username in usernames:
+            row = self.username_to_row.get(username)
+            if row is None:
+                if not create:
+                    rows.append(-1)
+                    continue
+                row = len(self.usernames)
+                self.usernames.append(username)
+                self.username_to_row[username] = row
+                if row // self.chunk_size == len(self.chunks):
+                    self._allocate_chunk()
+            rows.append(row)
+        return torch.tensor(rows, dtype=torch.long)
+
+    def get(self, usernames):
+        """
+        Batched lookup. Returns a [batch, num_dimensions] tensor (a copy; write changes back with `update`).
+        """
+        rows = self.rows(usernames)
+        out = torch.empty(len(rows), self.num_dimensions)
+        for chunk_id, mask, offsets in self._group_by_chunk(rows):
+            out[mask] = self.chunks[chunk_id][offsets]
+        return out
+
+    def update(self, usernames, vectors: torch.Tensor):
+        """
+        Batched write of `vectors` ([batch, num_dimensions]) into the users' rows.
+        """
+        rows = self.rows(usernames)
+        vectors = vectors.detach().to(torch.float32)
+        for chunk_id, mask, offsets in self._group_by_chunk(rows):
+            self.chunks[chunk_id][offsets] = vectors[mask]
+            self.dirty.add(chunk_id)
+
+    def close(self):
+        """
+        Delete the temporary spill directory, if the table created one. Save the table first to keep it.
+        """
+        if self.owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.owns_spill_dir = False
+
+    def __del__(self):
+        # the constructor may have failed before the attribute was set
+        if getattr(self, "owns_spill_dir", False):
+            self.close()
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for chunk_id in range(len(self.chunks)):
+            chunk_file = os.path.join(path, f"chunk_{chunk_id:06d}.npy")
+            if self.chunks[chunk_id] is not None:
+                np.save(chunk_file, self.chunks[chunk_id].numpy())
+            elif os.path.abspath(self.chunk_files[chunk_id]) != os.path.abspath(chunk_file):
+                shutil.copyfile(self.chunk_files[chunk_id], chunk_file)
+        with open(os.path.join(path, "usernames.json"), "w") as f:
+            json.dump(self.usernames, f)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump({
+                "num_dimensions": self.num_dimensions,
+                "chunk_size": self.chunk_size,
+                "num_rows": len(self.usernames),
+                "num_chunks": len(self.chunks),
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str, max_resident_chunks: int = 64, spill_dir: str = None):
+        """
+        Open a table written by `save`. No chunk is read until one of its users is looked up,
+        and the saved files are never modified (changed chunks are spilled to `spill_dir`).
+        """
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        table = cls(manifest["num_dimensions"], manifest["chunk_size"], max_resident_chunks, spill_dir)
+        with open(os.path.join(path, "usernames.json"), "r") as f:
+            table.usernames = json.load(f)
+        table.username_to_row = {username: i for i, username in enumerate(table.usernames)}
+        table.chunks = [None] * manifest["num_chunks"]
+        table.chunk_files = [os.path.join(path, f"chunk_{chunk_id:06d}.npy") for chunk_id in range(manifest["num_chunks"])]
+        return table
+
+    def _allocate_chunk(self):
+        chunk_id = len(self.chunks)
+        self.chunks.append(torch.randn(self.chunk_size, self.num_dimensions) * self.init_std)
+        self.chunk_files.append(None)
+        self.resident[chunk_id] = None
+        self.dirty.add(chunk_id)
+        self._evict(keep={chunk_id})
+
+    def _group_by_chunk(self, rows):
+        """
+        Yields (chunk_id, mask over the batch, row offsets within the chunk) for each chunk the batch touches,
+        after making sure all of those chunks are resident.
+        """
+        chunk_ids = rows // self.chunk_size
+        offsets = rows % self.chunk_size
+        unique_chunk_ids = chunk_ids.unique().tolist()
+        for chunk_id in unique_chunk_ids:
+            self._make_resident(chunk_id)
+        # a batch may touch more chunks than max_resident_chunks; evict only once all of them are loaded
+        self._evict(keep=set(unique_chunk_ids))
+
+        for chunk_id in unique_chunk_ids:
+            mask = chunk_ids == chunk_id
+            yield chunk_id, mask, offsets[mask]
+
+    def _make_resident(self, chunk_id):
+        if self.chunks[chunk_id] is None:
+            # read into RAM: the chunk is written to in place, and saved files must not change
+            self.chunks[chunk_id] = torch.from_numpy(np.load(self.chunk_files[chunk_id]))
+        self.resident[chunk_id] = None
+        self.resident.move_to_end(chunk_id)
+
+    def _evict(self, keep):
+        for chunk_id in list(self.resident.keys()):
+            if len(self.resident) <= self.max_resident_chunks:
+                break
+            if chunk_id in keep:
+                continue
+            if chunk_id in self.dirty or self.chunk_files[chunk_id] is None:
+                chunk_file = os.path.join(self.spill_dir, f"chunk_{chunk_id:06d}.npy")
+                np.save(chunk_file, self.chunks[chunk_id].numpy())
+                self.chunk_files[chunk_id] = chunk_file
+                self.dirty.discard(chunk_id)
+            self.chunks[chunk_id] = None
+            del self.resident[chunk_id]